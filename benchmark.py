@@ -0,0 +1,114 @@
+import os
+import random
+import struct
+import sys
+import tempfile
+import timeit
+
+# no window is needed to measure the drawing routines
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+import main
+
+
+def blend_image_per_pixel(image1, image2, blend_factor):
+    # the original implementation of blend_image, kept as a reference
+    width = image1.get_rect().width
+    height = image1.get_rect().height
+    surface1 = pygame.Surface((width, height), pygame.SRCALPHA, 32)
+    surface1.blit(image1, (0, 0))
+    surface2 = pygame.Surface((width, height), pygame.SRCALPHA, 32)
+    surface2.blit(image2, (0, 0))
+    for h in range(height):
+        for w in range(width):
+            color1 = surface1.get_at((w, h))
+            color2 = surface2.get_at((w, h))
+
+            r = color1[0]*(1-blend_factor)+color2[0]*blend_factor
+            if r > 255:
+                r = 255
+            g = color1[1]*(1-blend_factor)+color2[1]*blend_factor
+            if g > 255:
+                g = 255
+            b = color1[2]*(1-blend_factor)+color2[2]*blend_factor
+            if b > 255:
+                b = 255
+            a = color1[3]*(1-blend_factor)+color2[3]*blend_factor
+            if a > 255:
+                a = 255
+            color = (r, g, b, a)
+            surface1.set_at((w, h), color)
+
+    return surface1
+
+
+def max_difference(surface1, surface2):
+    difference = 0
+    for h in range(surface1.get_height()):
+        for w in range(surface1.get_width()):
+            color1 = surface1.get_at((w, h))
+            color2 = surface2.get_at((w, h))
+            for i in range(4):
+                difference = max(difference, abs(color1[i] - color2[i]))
+    return difference
+
+
+def benchmark_blend_image(image_name="Sword5", blend_factor=0.4, number=3):
+    images = main.split_image(main.load_image("skilleffect", image_name+".png"), main.SKILL_EFFECT_SIZE)
+    image1, image2 = images[3], images[4]
+    reference = blend_image_per_pixel(image1, image2, blend_factor)
+    print("blend_image (%s, %dx%d)" % (image_name, image1.get_width(), image1.get_height()))
+    for name, function in [("per pixel", blend_image_per_pixel),
+                           ("numpy", main.blend_image_array if main.numpy else None),
+                           ("blend flags", main.blend_image_blit)]:
+        if not function:
+            print("  %-12s skipped (numpy is not installed)" % name)
+            continue
+        seconds = timeit.timeit(lambda: function(image1, image2, blend_factor), number=number) / number
+        difference = max_difference(reference, function(image1, image2, blend_factor))
+        print("  %-12s %9.3f ms  max difference %d" % (name, seconds*1000, difference))
+
+
+def load_map_per_byte(file_path):
+    # the original implementation of Map.load, kept as a reference
+    file = open(file_path, "rb")
+    row = struct.unpack("i", file.read(struct.calcsize("i")))[0]
+    column = struct.unpack("i", file.read(struct.calcsize("i")))[0]
+    default = struct.unpack("B", file.read(struct.calcsize("B")))[0]
+    tiles = [[4 for c in range(column)] for r in range(row)]
+    for r in range(row):
+        for c in range(column):
+            tiles[r][c] = struct.unpack("B", file.read(struct.calcsize("B")))[0]
+    file.close()
+    return tiles
+
+
+def benchmark_map_load(row=1000, column=1000, number=3):
+    directory = tempfile.mkdtemp()
+    file_path = os.path.join(directory, "benchmark.map")
+    with open(file_path, "wb") as file:
+        file.write(struct.pack(main.Map.HEADER_FORMAT, row, column, main.Map.default))
+        file.write(bytes(random.randrange(256) for i in range(row*column)))
+    map = main.Map.__new__(main.Map)
+    map.name = "benchmark"
+    print("Map.load (%dx%d)" % (column, row))
+    reference = load_map_per_byte(file_path)
+    seconds = timeit.timeit(lambda: load_map_per_byte(file_path), number=1)
+    print("  %-12s %9.3f ms" % ("per byte", seconds*1000))
+    for name, mmap_size in [("read", row*column), ("mmap", 0)]:
+        main.Map.MMAP_SIZE, mmap_size = mmap_size, main.Map.MMAP_SIZE
+        seconds = timeit.timeit(lambda: map.load(directory), number=number) / number
+        main.Map.MMAP_SIZE = mmap_size
+        same = all(map.map[y*column + x] == reference[y][x] for y in range(row) for x in range(column))
+        print("  %-12s %9.3f ms  same tiles %s" % (name, seconds*1000, same))
+    map.map = None
+    os.remove(file_path)
+    os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    pygame.init()
+    pygame.display.set_mode(main.SCREEN_RECT.size)
+    benchmark_blend_image(*sys.argv[1:2])
+    benchmark_map_load()
@@ -3,8 +3,19 @@ from pygame.locals import *
 import sys
 import os
 import random
+import time
 import struct
+import mmap
+import io
+import json
 import copy
+import threading
+import queue
+from collections import OrderedDict, Counter
+try:
+    import numpy  # optional, used by blend_image
+except ImportError:
+    numpy = None
 
 SCREEN_RECT = Rect(0, 0, 640, 480)
 TILE_SIZE = 32
@@ -14,6 +25,7 @@ STOP, AUTO_MOVE, INPUT_MOVE = 0, 1, 2
 AUTO_MOVE_RATE = 0.05  # how often NPC moves
 ENCOUNTER_RATE = 0.05  # how often the player encounter a monster
 SKILL_EFFECT_SIZE = 192
+CHUNK_SIZE = 20  # [tile], side of a pre-rendered map chunk, should cover the screen width
 
 # game state
 TITLE, FILLED, TALK, COMMAND, \
@@ -29,25 +41,418 @@ DARK_GREEN = (87, 144, 151)
 LIGHT_BLUE = (17, 248, 216)
 HP_RED = (255, 45, 0, 0)
 MANA_BLUE = (0, 135, 255, 0)
+COLOR_KEY = (255, 0, 255)  # transparent color of the cached status bars
 
 full_screen_flag = False
 
-sounds = {}  # { name: sound file }
+dirty_rects = []  # areas of the screen changed in this frame
 
 game_state = TITLE
 
 
-def load_image(directory, filename):
-    file_path = os.path.join(directory, filename)
-    try:
-        image = pygame.image.load(file_path).convert_alpha()
-    except pygame.error:
-        print("Cannot find image", file_path)
-        image = None
-    return image
+class AssetPack:
+    # the data files and the decoded images compiled into one file by 'python main.py pack'
+    # the pack is memory mapped and each file is read only when it is asked for
+    MAGIC = b"LKPK"
+    VERSION = 1
+    HEADER_FORMAT = "<4sIQQ"  # magic, version, offset and size of the index
+    FILE_PATH = os.path.join("data", "assets.pack")
+    SOURCES = [("data", (".dat", ".evt", ".shop", ".map", ".png")),
+               ("mapchip", (".png",)), ("charachip", (".png",)), ("enemybatch", (".png",)), ("itemicon", (".png",))]
+
+    def __init__(self, file_path):
+        with open(file_path, "rb") as file:
+            self.buffer = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        magic, version, index_offset, index_size = struct.unpack_from(self.HEADER_FORMAT, self.buffer)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError("%s is not an asset pack of version %d" % (file_path, self.VERSION))
+        # { file path: [offset, size, mtime of the source, size of the source, image size or None] }
+        self.index = json.loads(bytes(self.buffer[index_offset:index_offset+index_size]).decode("utf8"))
+        self.stale = 0  # files changed after the pack was built, read from the disk instead
+
+    @staticmethod
+    def get_key(file_path):
+        return os.path.normpath(file_path).replace(os.sep, "/")
+
+    def find(self, file_path):
+        entry = self.index.get(self.get_key(file_path))
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return entry  # shipped without the loose files
+        if stat.st_mtime_ns != entry[2] or stat.st_size != entry[3]:
+            self.stale += 1
+            return None
+        return entry
+
+    def read_file(self, file_path):
+        # the contents of the file, or None when the pack doesn't have a fresh copy of it
+        entry = self.find(file_path)
+        if entry is None or entry[4] is not None:
+            return None
+        return self.buffer[entry[0]:entry[0]+entry[1]]
+
+    def load_image(self, file_path):
+        entry = self.find(file_path)
+        if entry is None or entry[4] is None:
+            return None
+        pixels = self.buffer[entry[0]:entry[0]+entry[1]]
+        return pygame.image.frombuffer(pixels, entry[4], "RGBA").convert_alpha()
+
+    @classmethod
+    def build(cls, file_path):
+        # the images are stored as decoded pixels, so a display is needed to convert them the same way as the game
+        pygame.display.init()
+        pygame.display.set_mode((1, 1), pygame.HIDDEN)
+        index = {}
+        with open(file_path, "wb") as file:
+            file.write(struct.pack(cls.HEADER_FORMAT, cls.MAGIC, cls.VERSION, 0, 0))
+            for directory, extensions in cls.SOURCES:
+                for filename in sorted(os.listdir(directory)):
+                    source_path = os.path.join(directory, filename)
+                    if not filename.endswith(extensions) or source_path == file_path:
+                        continue
+                    if filename.endswith(".png"):
+                        image = pygame.image.load(source_path).convert_alpha()
+                        data = pygame.image.tobytes(image, "RGBA")
+                        image_size = image.get_size()
+                    else:
+                        with open(source_path, "rb") as source:
+                            data = source.read()
+                        image_size = None
+                    stat = os.stat(source_path)
+                    index[cls.get_key(source_path)] = [file.tell(), len(data), stat.st_mtime_ns, stat.st_size, image_size]
+                    file.write(data)
+            index_data = json.dumps(index).encode("utf8")
+            index_offset = file.tell()
+            file.write(index_data)
+            file.seek(0)
+            file.write(struct.pack(cls.HEADER_FORMAT, cls.MAGIC, cls.VERSION, index_offset, len(index_data)))
+        return len(index)
+
+
+class AssetManager:
+    # every image is loaded through here, so that each file is decoded only once
+    # the surfaces are shared by everyone who loads the same file and must not be drawn on
+
+    def __init__(self):
+        self.images = {}  # { file path: surface }
+        self.groups = {}  # { file path: set of the groups using it }, None for the images never unloaded
+        self.pixel_bytes = 0  # held by all the images
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # images are also loaded by the prefetch threads
+        self.pack = None
+
+    def open_pack(self, file_path=AssetPack.FILE_PATH):
+        # use the compiled asset pack if it has been built, the loose files are used for anything missing or stale
+        if not os.path.exists(file_path):
+            return
+        try:
+            self.pack = AssetPack(file_path)
+        except (ValueError, struct.error) as error:
+            print("Cannot use the asset pack:", error)
+
+    def open_file(self, file_path, mode="r", encoding=None):
+        data = self.pack.read_file(file_path) if self.pack else None
+        if data is None:
+            return open(file_path, mode, encoding=encoding)
+        if "b" in mode:
+            return io.BytesIO(data)
+        return io.TextIOWrapper(io.BytesIO(data), encoding=encoding)
+
+    def load_image(self, directory, filename, group=None):
+        file_path = os.path.join(directory, filename)
+        with self.lock:
+            image = self.images.get(file_path)
+            if image is not None:
+                self.hits += 1
+                self.groups[file_path].add(group)
+                return image
+            self.misses += 1
+        image = self.pack.load_image(file_path) if self.pack else None
+        if image is None:
+            try:
+                image = pygame.image.load(file_path).convert_alpha()
+            except (pygame.error, OSError):
+                print("Cannot find image", file_path)
+                return None
+        with self.lock:
+            if file_path in self.images:
+                image = self.images[file_path]  # loaded by another thread in the meantime
+            else:
+                self.images[file_path] = image
+                self.pixel_bytes += image.get_pitch() * image.get_height()
+            self.groups.setdefault(file_path, set()).add(group)
+        return image
+
+    def release(self, directory, filename, group):
+        # stop using one image of the group
+        with self.lock:
+            self.discard(os.path.join(directory, filename), group)
+
+    def unload(self, group):
+        # forget the images used only by the group (e.g. "battle")
+        with self.lock:
+            for file_path in list(self.groups):
+                self.discard(file_path, group)
+
+    def discard(self, file_path, group):
+        groups = self.groups.get(file_path)
+        if groups is None:
+            return
+        groups.discard(group)
+        if not groups:
+            del self.groups[file_path]
+            image = self.images.pop(file_path)
+            self.pixel_bytes -= image.get_pitch() * image.get_height()
+
+
+assets = AssetManager()
+
+
+class SoundRegistry:
+    # sound effects by name, decoded on first use: sounds["pi"].play()
+    MAX_BYTES = 8 * 1024 * 1024  # [byte], decoded samples kept in memory, the least recently played ones go first
+    WARM_UP = ["pi", "cancel", "step", "door", "treasure"]  # decoded in the background while the title is shown
+    VOLUME = 0.01
+
+    def __init__(self):
+        self.file_paths = {}  # { name: file path }
+        self.sounds = OrderedDict()  # { name: decoded sound }, least recently played first
+        self.sound_bytes = 0
+        self.lock = threading.Lock()  # the warm up thread decodes too
+
+    def register(self, directory):
+        for file_name in os.listdir(directory):
+            if not file_name.startswith("."):  # .DS_Store
+                self.file_paths[os.path.splitext(file_name)[0]] = os.path.join(directory, file_name)
+
+    def __contains__(self, name):
+        return name in self.file_paths
+
+    def __getitem__(self, name):
+        with self.lock:
+            sound = self.sounds.get(name)
+            if sound is not None:
+                self.sounds.move_to_end(name)
+                return sound
+            sound = pygame.mixer.Sound(self.file_paths[name])
+            sound.set_volume(self.VOLUME)
+            self.sounds[name] = sound
+            self.sound_bytes += self.get_sound_bytes(sound)
+            for old_name in list(self.sounds):
+                if self.sound_bytes <= self.MAX_BYTES:
+                    break
+                old_sound = self.sounds[old_name]
+                if old_name != name and old_sound.get_num_channels() == 0:  # don't cut off a playing sound
+                    del self.sounds[old_name]
+                    self.sound_bytes -= self.get_sound_bytes(old_sound)
+            return sound
+
+    @staticmethod
+    def get_sound_bytes(sound):
+        frequency, size, channels = pygame.mixer.get_init()
+        return int(sound.get_length() * frequency) * channels * abs(size) // 8
+
+    def warm_up(self, names):
+        threading.Thread(target=self.decode, args=(names,), daemon=True).start()
+
+    def decode(self, names):
+        for name in names:
+            if name in self:
+                self[name]
+
+
+sounds = SoundRegistry()  # { name: sound effect }
+
+
+def get_ogg_length(file_path):
+    # [second], from the sample rate in the first page and the last granule position of an Ogg Vorbis file
+    with open(file_path, "rb") as file:
+        head = file.read(64)
+        packet = 27 + head[26]  # after the page header and its segment table
+        if head[:4] != b"OggS" or head[packet+1:packet+7] != b"vorbis":
+            return None
+        sample_rate = struct.unpack_from("<I", head, packet+12)[0]
+        file.seek(0, os.SEEK_END)
+        file.seek(max(0, file.tell() - 65536))
+        tail = file.read()
+    last_page = tail.rfind(b"OggS")
+    if last_page < 0 or not sample_rate:
+        return None
+    return struct.unpack_from("<q", tail, last_page+6)[0] / sample_rate
+
+
+class MusicManager:
+    # plays the background music
+    # the track already playing is not loaded again, and a track continues where it was left when it comes back
+    FADE_TIME = 300  # [ms], to fade out the old track and fade in the new one, 0 to switch at once
+    VOLUME = 0.01
+
+    def __init__(self):
+        self.file_path = None  # track playing
+        self.start = 0  # [second], position the track started playing from
+        self.positions = {}  # { file path: [second] position where the track was left }
+        self.lengths = {}  # { file path: [second] length of the track, None if unknown }
+        self.next_file_path = None  # track to play after the fade out
+        self.next_resume = True
+        self.fade_start = 0
+
+    def play(self, file_path, resume=True):
+        if self.next_file_path:
+            if file_path == self.file_path:
+                # back to the track fading out
+                self.next_file_path = None
+                pygame.mixer.music.set_volume(self.VOLUME)
+                return
+            if file_path == self.next_file_path:
+                return
+        elif file_path == self.file_path and pygame.mixer.music.get_busy():
+            return
+        if self.FADE_TIME and self.file_path and pygame.mixer.music.get_busy():
+            # the fade out is done a little every frame by update
+            self.next_file_path = file_path
+            self.next_resume = resume
+            self.fade_start = pygame.time.get_ticks()
+        else:
+            self.switch(file_path, resume)
+
+    def update(self):
+        # should be called every frame
+        if not self.next_file_path:
+            return
+        progress = (pygame.time.get_ticks() - self.fade_start) / self.FADE_TIME
+        if progress < 1:
+            pygame.mixer.music.set_volume(self.VOLUME * (1 - progress))
+        else:
+            self.switch(self.next_file_path, self.next_resume)
+
+    def switch(self, file_path, resume):
+        if self.file_path:
+            position = self.get_position()
+            if position is not None:
+                self.positions[self.file_path] = position
+        start = self.positions.get(file_path, 0) if resume else 0
+        pygame.mixer.music.load(file_path)
+        pygame.mixer.music.set_volume(self.VOLUME)
+        try:
+            pygame.mixer.music.play(-1, start, self.FADE_TIME)  # loop
+        except pygame.error:
+            # some formats can't start in the middle
+            start = 0
+            pygame.mixer.music.play(-1, start, self.FADE_TIME)
+        self.file_path = file_path
+        self.start = start
+        self.next_file_path = None
+
+    def get_position(self):
+        if self.file_path not in self.lengths:
+            try:
+                self.lengths[self.file_path] = get_ogg_length(self.file_path)
+            except (OSError, struct.error):
+                self.lengths[self.file_path] = None
+        length = self.lengths[self.file_path]
+        elapsed = pygame.mixer.music.get_pos()
+        if not length or elapsed < 0:
+            return None
+        return (self.start + elapsed / 1000) % length
+
+
+music = MusicManager()
+
+
+def load_image(directory, filename, group=None):
+    return assets.load_image(directory, filename, group)
+
+
+class TextureAtlas:
+    # many small images packed into a few large sheets, each image is handed out as a view of its sheet
+
+    def __init__(self, sheet_size):
+        self.sheet_size = sheet_size
+        self.sheets = []
+        self.rects = {}  # { name: (sheet, area of the image in the sheet) }
+        self.free_rects = {}  # { (width, height): [(sheet, area)] }, areas of the removed images
+        # the sheet being filled, row by row (shelf)
+        self.sheet = None
+        self.shelf_x = 0
+        self.shelf_y = 0
+        self.shelf_height = 0
+
+    def pack(self, images):
+        # images: { name: surface }, the tallest ones go first to waste less space on the shelves
+        for name in sorted(images, key=lambda name: -images[name].get_height()):
+            self.add(name, images[name])
+
+    def add(self, name, image):
+        width, height = image.get_size()
+        free_rects = self.free_rects.get((width, height))
+        if free_rects:
+            sheet, rect = free_rects.pop()
+            sheet.fill((0, 0, 0, 0), rect)
+        else:
+            sheet, rect = self.allocate(width, height)
+        #  BLEND_RGBA_MAX onto the transparent sheet copies the pixels as they are
+        sheet.blit(image, rect, special_flags=BLEND_RGBA_MAX)
+        self.rects[name] = (sheet, rect)
+        return sheet.subsurface(rect)
+
+    def allocate(self, width, height):
+        if width > self.sheet_size or height > self.sheet_size:
+            sheet = pygame.Surface((width, height), pygame.SRCALPHA, 32).convert_alpha()
+            sheet.fill((0, 0, 0, 0))
+            self.sheets.append(sheet)
+            return sheet, Rect(0, 0, width, height)
+        if self.sheet is not None and self.shelf_x + width > self.sheet_size:
+            self.shelf_x = 0
+            self.shelf_y += self.shelf_height
+            self.shelf_height = 0
+        if self.sheet is None or self.shelf_y + height > self.sheet_size:
+            self.sheet = pygame.Surface((self.sheet_size, self.sheet_size), pygame.SRCALPHA, 32).convert_alpha()
+            self.sheet.fill((0, 0, 0, 0))
+            self.sheets.append(self.sheet)
+            self.shelf_x = 0
+            self.shelf_y = 0
+            self.shelf_height = 0
+        rect = Rect(self.shelf_x, self.shelf_y, width, height)
+        self.shelf_x += width
+        self.shelf_height = max(self.shelf_height, height)
+        return self.sheet, rect
+
+    def get(self, name):
+        sheet, rect = self.rects[name]
+        return sheet.subsurface(rect)
+
+    def remove(self, name):
+        # the area is reused by the next image of the same size
+        sheet, rect = self.rects.pop(name)
+        self.free_rects.setdefault(rect.size, []).append((sheet, rect))
+
+    def get_pixel_bytes(self):
+        return sum(sheet.get_pitch() * sheet.get_height() for sheet in self.sheets)
+
+
+def mark_dirty(*rects):
+    for rect in rects:
+        if rect:
+            dirty_rects.append(Rect(rect))
+
+
+def mark_changed(drawable, state, rect):
+    # mark the area of the drawable dirty when what it draws has changed since the last frame
+    # state is anything that can be compared with the state of the last frame
+    drawn_state, drawn_rect = getattr(drawable, "drawn", (None, None))
+    if state != drawn_state or rect != drawn_rect:
+        mark_dirty(drawn_rect, rect)
+        drawable.drawn = (state, rect)
 
 
 def split_image(image, size):
+    # the cells are views of the sheet (subsurfaces), so no pixel is copied
+    # and the sheet is kept alive as long as any of its cells
     image_list = []
     width = image.get_rect().width
     height = image.get_rect().height
@@ -55,55 +460,81 @@ def split_image(image, size):
     column = int(width / size)
     for r in range(0, row*size, size):
         for c in range(0, column*size, size):
-            trimmed_image = pygame.Surface((size, size), pygame.SRCALPHA, 32)
-            trimmed_image.blit(image, (0, 0), (c, r, size, size))
-            #  The optional flags argument can be set to pygame.RLEACCEL
-            #  to provide better performance on non accelerated displays
-            #  choose the pixel color at top-left to be transparent
-            # trimmed_image.set_colorkey(trimmed_image.get_at((0, 0)), RLEACCEL)
-            #  make the image editable
-            trimmed_image.convert()
-            image_list.append(trimmed_image)
+            image_list.append(image.subsurface((c, r, size, size)))
     return image_list
 
 
 def blend_image(image1, image2, blend_factor):
     # image1 and image2 are the same size
     # blend image2 on image1
+    if numpy:
+        return blend_image_array(image1, image2, blend_factor)
+    return blend_image_blit(image1, image2, blend_factor)
+
+
+def blend_image_array(image1, image2, blend_factor):
+    # blend all the pixels at once with numpy instead of get_at/set_at per pixel
     width = image1.get_rect().width
     height = image1.get_rect().height
     surface1 = pygame.Surface((width, height), pygame.SRCALPHA, 32)
     surface1.blit(image1, (0, 0))
     surface2 = pygame.Surface((width, height), pygame.SRCALPHA, 32)
     surface2.blit(image2, (0, 0))
-    blend_alpha = int(255 * blend_factor)
-    for h in range(height):
-        for w in range(width):
-            color1 = surface1.get_at((w, h))
-            color2 = surface2.get_at((w, h))
-
-            r = color1[0]*(1-blend_factor)+color2[0]*blend_factor
-            if r > 255:
-                r = 255
-            g = color1[1]*(1-blend_factor)+color2[1]*blend_factor
-            if g > 255:
-                g = 255
-            b = color1[2]*(1-blend_factor)+color2[2]*blend_factor
-            if b > 255:
-                b = 255
-            a = color1[3]*(1-blend_factor)+color2[3]*blend_factor
-            if a > 255:
-                a = 255
-            color = (r, g, b, a)
-            # print(color)
-            surface1.set_at((w, h), color)
+    #  pixels3d and pixels_alpha reference the pixels of the surface directly
+    #  and keep it locked until they are deleted
+    color1 = pygame.surfarray.pixels3d(surface1)
+    alpha1 = pygame.surfarray.pixels_alpha(surface1)
+    color2 = pygame.surfarray.pixels3d(surface2)
+    alpha2 = pygame.surfarray.pixels_alpha(surface2)
+    #  set_at truncates the fractions, and so does astype
+    color = color1*(1-blend_factor)+color2*blend_factor
+    color1[...] = numpy.clip(color, 0, 255).astype(numpy.uint8)
+    alpha = alpha1*(1-blend_factor)+alpha2*blend_factor
+    alpha1[...] = numpy.clip(alpha, 0, 255).astype(numpy.uint8)
+    del color1, alpha1, color2, alpha2
+    return surface1
+
 
+def blend_image_blit(image1, image2, blend_factor):
+    # fallback without numpy: scale both images with BLEND_RGBA_MULT and add them up
+    # the result can be off by a few levels because of the integer arithmetic of the blend flags
+    width = image1.get_rect().width
+    height = image1.get_rect().height
+    surface1 = pygame.Surface((width, height), pygame.SRCALPHA, 32)
+    surface1.blit(image1, (0, 0))
+    surface2 = pygame.Surface((width, height), pygame.SRCALPHA, 32)
+    surface2.blit(image2, (0, 0))
+    blend_alpha = min(max(int(255 * blend_factor), 0), 255)
+    surface1.fill((255-blend_alpha, 255-blend_alpha, 255-blend_alpha, 255-blend_alpha), special_flags=BLEND_RGBA_MULT)
+    surface2.fill((blend_alpha, blend_alpha, blend_alpha, blend_alpha), special_flags=BLEND_RGBA_MULT)
+    surface1.blit(surface2, (0, 0), special_flags=BLEND_RGBA_ADD)
     return surface1
 
 
+class GameState:
+    # what the game does in one game state: the subsystems ticking in input, update and draw,
+    # and the handler of the events
+
+    def __init__(self, name, input, update, draw, handle_event):
+        self.name = name
+        self.input = input
+        self.update = update
+        self.draw = draw
+        self.handle_event = handle_event
+        self.reset_costs()
+
+    def reset_costs(self):
+        # { hook: [second] }, measured while profiling
+        self.costs = {"input": 0, "update": 0, "draw": 0, "handle_event": 0}
+        self.steps = 0  # input, update and handle_event run once per step
+        self.frames = 0  # draw runs once per frame
+
+
 class pyRPG:
+    TICK_RATE = 60  # [step per second] of the simulation
+    MAX_FRAME_SKIP = 5  # steps run at most before a frame is drawn
 
-    def __init__(self):
+    def __init__(self, render_cap=60):
         pygame.init()
         # DOUBLEBUF
         # using a separate block of memory to apply all the draw routines
@@ -119,6 +550,7 @@ class pyRPG:
         # self.screen = pygame.display.set_mode(SCREEN_RECT.size, DOUBLEBUF | HWSURFACE | FULLSCREEN)
         pygame.display.set_caption("Lanoir Kingdom")
 
+        assets.open_pack()
         self.load_sounds("se")
         self.load_character_chips("data", "charachip.dat")
         self.load_map_chips("data", "mapchip.dat")
@@ -146,70 +578,164 @@ class pyRPG:
         self.title = Title(self.message_engine)
         self.battle = Battle(self.message_window, self.message_engine, self.party)
 
+        # update only the dirty rects of the screen instead of the whole screen (toggle with F2)
+        self.dirty_rect_flag = False
+        self.full_update_flag = True
+        self.drawn_game_state = None
+        self.drawn_offsets = None
+        self.drawn_info = None
+
+        # what to do in each game state (measure the cost of each state with F3)
+        self.states = self.create_states()
+        self.create_key_bindings()
+        self.profile_flag = False
+
+        # [frame per second], 0 draws as many frames as possible
+        self.render_cap = render_cap
+
         global game_state
         game_state = TITLE
         self.game_loop()
 
     def game_loop(self):
+        # the simulation runs in fixed steps of 1 / TICK_RATE second whatever the frame rate,
+        # and the characters are drawn between their last two steps
         clock = pygame.time.Clock()
+        step = 1.0 / self.TICK_RATE
+        accumulator = 0.0
+        previous = time.perf_counter()
         while True:
             # print(game_state)
-            clock.tick(60)
-            self.input()
-            self.update()
+            clock.tick(self.render_cap)
+            now = time.perf_counter()
+            accumulator += now - previous
+            previous = now
+            music.update()
+            steps = 0
+            while accumulator >= step:
+                if steps == self.MAX_FRAME_SKIP:
+                    # too far behind, slow down instead of never drawing again
+                    accumulator = 0.0
+                    break
+                self.step()
+                accumulator -= step
+                steps += 1
+            Character.alpha = accumulator / step
             self.draw()
-            pygame.display.update()
-            self.check_event()
+            self.update_display()
+
+    def step(self):
+        if self.profile_flag:
+            self.states[game_state].steps += 1
+        for character in self.party.members + self.map.characters:
+            character.save_position()
+        self.input()
+        self.update()
+        self.check_event()
+
+    def create_states(self):
+        field_update = [self.map.update, self.party.update, self.prefetch_map]
+        battle_input = [self.battle.update, self.message_window.update]
+        battle_draw = [self.draw_battle]
+        return {
+            TITLE: GameState("TITLE", [self.title.input], [self.title.update], [self.draw_title], self.title_handler),
+            FILLED: GameState("FILLED", [self.map.input, self.input_party], field_update, [self.draw_field],
+                              self.field_handler),
+            TALK: GameState("TALK", [self.message_window.update], field_update, [self.draw_field], self.talk_handler),
+            COMMAND: GameState("COMMAND", [], field_update, [self.draw_field], self.command_window_handler),
+            BATTLE_INIT: GameState("BATTLE_INIT", battle_input, [], battle_draw, self.battle_init_handler),
+            BATTLE_COMMAND: GameState("BATTLE_COMMAND", battle_input, [], battle_draw, self.battle_command_handler),
+            BATTLE_PROCESS: GameState("BATTLE_PROCESS", battle_input, [], battle_draw, self.battle_process_handler),
+            BATTLE_ANIMATION: GameState("BATTLE_ANIMATION", battle_input, [], battle_draw,
+                                        self.battle_animation_handler),
+            BATTLE_FINISH: GameState("BATTLE_FINISH", battle_input, [], battle_draw, self.battle_finish_handler),
+            STATUS: GameState("STATUS", [], [self.player_status_window.update], [self.draw_player_status_window],
+                              self.player_status_window_handler),
+            SHOP: GameState("SHOP", [], [self.shop_window.update], [self.draw_shop_window], self.shop_window_handler),
+            ITEM: GameState("ITEM", [], [self.item_window.update], [self.draw_item_window], self.item_window_handler),
+        }
 
     def input(self):
-        global game_state
-        if game_state == TITLE:
-            self.title.input()
-        elif game_state == FILLED:
-            self.map.input()
-            self.party.input(self.map, self.battle)
-        elif game_state == TALK:
-            self.message_window.update()
-        elif game_state == BATTLE_INIT or game_state == BATTLE_COMMAND or game_state == BATTLE_PROCESS or game_state == BATTLE_ANIMATION or game_state == BATTLE_FINISH:
-            self.battle.update()
-            self.message_window.update()
+        self.run(self.states[game_state], "input")
 
     def update(self):
-        global game_state
-        if game_state == TITLE:
-            self.title.update()
-        elif game_state == FILLED or game_state == TALK or game_state == COMMAND:
-            self.map.update()
-            self.party.update()
-        elif game_state == TALK:
-            self.message_window.update()
-        elif game_state == STATUS:
-            self.player_status_window.update()
-        elif game_state == SHOP:
-            self.shop_window.update()
-        elif game_state == ITEM:
-            self.item_window.update()
+        self.run(self.states[game_state], "update")
 
     def draw(self):
         global game_state
-        if game_state == TITLE:
-            self.title.draw(self.screen)
-        elif game_state == FILLED or game_state == TALK or game_state == COMMAND:
-            offsets = self.calculate_offsets(self.party.members[0])
-            self.map.draw(self.screen, offsets)
-            self.party.draw(self.screen, offsets)
-            self.message_window.draw(self.screen)
-            self.command_window.draw(self.screen)
-            self.show_info()
-        elif game_state in (BATTLE_INIT, BATTLE_COMMAND, BATTLE_PROCESS, BATTLE_ANIMATION, BATTLE_FINISH):
-            self.battle.draw(self.screen)
-            self.message_window.draw(self.screen)
-        elif game_state == STATUS:
-            self.player_status_window.draw(self.screen)
-        elif game_state == SHOP:
-            self.shop_window.draw(self.screen)
-        elif game_state == ITEM:
-            self.item_window.draw(self.screen)
+        if game_state != self.drawn_game_state:
+            # everything on the screen is different in another game state
+            self.full_update_flag = True
+            self.drawn_game_state = game_state
+        state = self.states[game_state]
+        self.run(state, "draw")
+        if self.profile_flag:
+            state.frames += 1
+
+    def run(self, state, hook):
+        # call the subsystems of the state for the hook (input, update or draw)
+        if not self.profile_flag:
+            for subsystem in getattr(state, hook):
+                subsystem()
+            return
+        start = time.perf_counter()
+        for subsystem in getattr(state, hook):
+            subsystem()
+        state.costs[hook] += time.perf_counter() - start
+
+    def input_party(self):
+        self.party.input(self.map, self.battle)
+
+    def prefetch_map(self):
+        leader = self.party.members[0]
+        if leader.moving:
+            self.map.prefetch(self.calculate_offsets(leader.rect.topleft), leader.direction)
+
+    def draw_title(self):
+        self.title.draw(self.screen)
+
+    def draw_field(self):
+        # the camera follows the leader between its last two steps
+        offsets = self.calculate_offsets(self.party.members[0].get_draw_position())
+        if offsets != self.drawn_offsets:
+            # the whole map scrolls with the camera
+            self.full_update_flag = True
+            self.drawn_offsets = offsets
+        self.map.draw(self.screen, offsets)
+        self.party.draw(self.screen, offsets)
+        self.message_window.draw(self.screen)
+        self.command_window.draw(self.screen)
+        self.show_info()
+
+    def draw_battle(self):
+        self.battle.draw(self.screen)
+        self.message_window.draw(self.screen)
+
+    def draw_player_status_window(self):
+        self.player_status_window.draw(self.screen)
+
+    def draw_shop_window(self):
+        self.shop_window.draw(self.screen)
+
+    def draw_item_window(self):
+        self.item_window.draw(self.screen)
+
+    def print_costs(self):
+        for state in self.states.values():
+            if state.steps or state.frames:
+                print("%-16s %6d steps %6d frames" % (state.name, state.steps, state.frames),
+                      " ".join("%s %.3f ms/step" % (hook, state.costs[hook] / max(state.steps, 1) * 1000)
+                               for hook in ("input", "update", "handle_event")),
+                      "draw %.3f ms/frame" % (state.costs["draw"] / max(state.frames, 1) * 1000))
+            state.reset_costs()
+
+    def update_display(self):
+        if self.dirty_rect_flag and not self.full_update_flag:
+            pygame.display.update(dirty_rects)
+        else:
+            pygame.display.update()
+        self.full_update_flag = False
+        del dirty_rects[:]
 
     def check_event(self):  # input
         for event in pygame.event.get():
@@ -220,39 +746,34 @@ class pyRPG:
                 if event.key == K_ESCAPE:
                     pygame.quit()
                     sys.exit()
+                elif event.key == K_F2:
+                    self.dirty_rect_flag = not self.dirty_rect_flag
+                    self.full_update_flag = True
+                    print("dirty rect update", "on" if self.dirty_rect_flag else "off")
+                elif event.key == K_F3:
+                    # print the average cost of each game state since profiling started
+                    if self.profile_flag:
+                        self.print_costs()
+                    else:
+                        for state in self.states.values():
+                            state.reset_costs()
+                    self.profile_flag = not self.profile_flag
 
             # change the event handler based on the game state
-            global game_state
-            if game_state == TITLE:
-                self.title_handler(event)
-            elif game_state == FILLED:
-                self.field_handler(event)
-            elif game_state == COMMAND:
-                self.command_window_handler(event)
-            elif game_state == TALK:
-                self.talk_handler(event)
-            elif game_state == BATTLE_INIT:
-                self.battle_init_handler(event)
-            elif game_state == BATTLE_COMMAND:
-                self.battle_command_handler(event)
-            elif game_state == BATTLE_PROCESS:
-                self.battle_process_handler(event)
-            elif game_state == BATTLE_ANIMATION:
-                self.battle_animation_handler(event)
-            elif game_state == BATTLE_FINISH:
-                self.battle_finish_handler(event)
-            elif game_state == STATUS:
-                self.player_status_window_handler(event)
-            elif game_state == SHOP:
-                self.shop_window_handler(event)
-            elif game_state == ITEM:
-                self.item_window_handler(event)
+            state = self.states[game_state]
+            if self.profile_flag:
+                start = time.perf_counter()
+                state.handle_event(event)
+                state.costs["handle_event"] += time.perf_counter() - start
+            else:
+                state.handle_event(event)
 
     def battle_finish_handler(self, event):
         global game_state
         if event.type == KEYDOWN and event.key == K_SPACE:
             if not self.message_window.next_flag:
                 global game_state
+                self.battle.finish()
                 self.map.play_bgm()
                 game_state = FILLED
                 self.message_window.hide()
@@ -278,273 +799,56 @@ class pyRPG:
                 game_state = BATTLE_FINISH
 
     def item_window_handler(self, event):
+        if event.type != KEYDOWN:
+            return
+        move = ItemWindow.NAVIGATION.move((self.item_window.cursor_is_in, self.item_window.cursor_position), event.key)
+        if move:
+            (self.item_window.cursor_is_in, self.item_window.cursor_position), sound = move
+            if sound:
+                sounds["pi"].play()
+            return
+        action = self.item_window_keys.get(event.key)
+        if action:
+            action()
+
+    def close_item_window(self):
         global game_state
-        if event.type == KEYDOWN and event.key == K_q:
-            sounds["pi"].play()
-            # reset everything
-            self.item_window.cursor_position = 0
-            self.item_window.cursor_is_in = self.item_window.INVENTORY_RECT
-            self.item_window.is_grabbing = False
-            if self.item_window.selected_item:
-                Player.inventory[self.item_window.selected_item_position] = self.item_window.selected_item
+        sounds["pi"].play()
+        # reset everything
+        self.item_window.cursor_position = 0
+        self.item_window.cursor_is_in = self.item_window.INVENTORY_RECT
+        self.item_window.is_grabbing = False
+        if self.item_window.selected_item:
+            Player.inventory[self.item_window.selected_item_position] = self.item_window.selected_item
+            self.item_window.selected_item = None
+            self.item_window.selected_item_position = None
+            self.item_window.invalidate_item_layer()
+        game_state = FILLED
+
+    def grab_item(self):
+        # grab the item under the cursor, or put the grabbed item there
+        if self.item_window.cursor_is_in == self.item_window.DROP_RECT:
+            if self.item_window.is_grabbing:
                 self.item_window.selected_item = None
                 self.item_window.selected_item_position = None
-            game_state = FILLED
-        if event.type == KEYDOWN and event.key == K_LEFT:
-            if self.item_window.cursor_is_in == self.item_window.INVENTORY_RECT:
-                sounds["pi"].play()
-                if self.item_window.cursor_position == 0:
-                    self.item_window.cursor_is_in = self.item_window.BAG_RECT
-                    self.item_window.cursor_position = 4
-                elif self.item_window.cursor_position == 5:
-                    self.item_window.cursor_is_in = self.item_window.EQUIPMENT_RECT
-                    self.item_window.cursor_position = 1
-                elif self.item_window.cursor_position == 10 or self.item_window.cursor_position == 15:
-                    self.item_window.cursor_is_in = self.item_window.EQUIPMENT_RECT
-                    self.item_window.cursor_position = 3
-                elif self.item_window.cursor_position == 20:
-                    self.item_window.cursor_is_in = self.item_window.EQUIPMENT_RECT
-                    self.item_window.cursor_position = 5
-                else:
-                    self.item_window.cursor_position -= 1
-            elif self.item_window.cursor_is_in == self.item_window.DROP_RECT:
-                sounds["pi"].play()
-                self.item_window.cursor_is_in = self.item_window.INVENTORY_RECT
-                self.item_window.cursor_position = 24
-            elif self.item_window.cursor_is_in == self.item_window.BAG_RECT:
-                if not self.item_window.cursor_position == 0:
-                    sounds["pi"].play()
-                    self.item_window.cursor_position -= 1
-            elif self.item_window.cursor_is_in == self.item_window.EQUIPMENT_RECT:
-                if self.item_window.cursor_position == 1 \
-                        or self.item_window.cursor_position == 3 \
-                        or self.item_window.cursor_position == 5:
-                    sounds["pi"].play()
-                    self.item_window.cursor_position -= 1
-
-        elif event.type == KEYDOWN and event.key == K_RIGHT:
-            if self.item_window.cursor_is_in == self.item_window.INVENTORY_RECT:
-                if self.item_window.cursor_position == 4 \
-                        or self.item_window.cursor_position == 9 \
-                        or self.item_window.cursor_position == 14 \
-                        or self.item_window.cursor_position == 19 \
-                        or self.item_window.cursor_position == 24:
-                    self.item_window.cursor_is_in = self.item_window.DROP_RECT
-                    self.item_window.cursor_position = 0
-                else:
-                    self.item_window.cursor_position += 1
-                    sounds["pi"].play()
-            elif self.item_window.cursor_is_in == self.item_window.DROP_RECT:
-                pass
-            elif self.item_window.cursor_is_in == self.item_window.BAG_RECT:
-                if self.item_window.cursor_position == 4:
-                    self.item_window.cursor_is_in = self.item_window.INVENTORY_RECT
-                    self.item_window.cursor_position = 0
-                else:
-                    self.item_window.cursor_position += 1
-                sounds["pi"].play()
-            elif self.item_window.cursor_is_in == self.item_window.EQUIPMENT_RECT:
-                if self.item_window.cursor_position == 0 \
-                        or self.item_window.cursor_position == 2 \
-                        or self.item_window.cursor_position == 4:
-                    self.item_window.cursor_position += 1
-                elif self.item_window.cursor_position == 1:
-                    self.item_window.cursor_is_in = self.item_window.INVENTORY_RECT
-                    self.item_window.cursor_position = 5
-                elif self.item_window.cursor_position == 3:
-                    self.item_window.cursor_is_in = self.item_window.INVENTORY_RECT
-                    self.item_window.cursor_position = 10
-                elif self.item_window.cursor_position == 5:
-                    self.item_window.cursor_is_in = self.item_window.INVENTORY_RECT
-                    self.item_window.cursor_position = 20
-                sounds["pi"].play()
-
-        elif event.type == KEYDOWN and event.key == K_UP:
-            if self.item_window.cursor_is_in == self.item_window.INVENTORY_RECT:
-                if self.item_window.cursor_position - 5 >= 0:
-                    sounds["pi"].play()
-                    self.item_window.cursor_position -= 5
-            elif self.item_window.cursor_is_in == self.item_window.DROP_RECT:
-                pass
-            elif self.item_window.cursor_is_in == self.item_window.BAG_RECT:
-                pass
-            elif self.item_window.cursor_is_in == self.item_window.EQUIPMENT_RECT:
-                if self.item_window.cursor_position == 0:
-                    self.item_window.cursor_is_in = self.item_window.BAG_RECT
-                    self.item_window.cursor_position = 0
-                elif self.item_window.cursor_position == 1:
-                    self.item_window.cursor_is_in = self.item_window.BAG_RECT
-                    self.item_window.cursor_position = 4
-                else:
-                    self.item_window.cursor_position -= 2
-                sounds["pi"].play()
-
-        elif event.type == KEYDOWN and event.key == K_DOWN:
-            if self.item_window.cursor_is_in == self.item_window.INVENTORY_RECT:
-                if self.item_window.cursor_position + 5 < 25:
-                    sounds["pi"].play()
-                    self.item_window.cursor_position += 5
-            elif self.item_window.cursor_is_in == self.item_window.DROP_RECT:
-                pass
-            elif self.item_window.cursor_is_in == self.item_window.BAG_RECT:
-                if self.item_window.cursor_position == 0 or self.item_window.cursor_position == 1:
-                    sounds["pi"].play()
-                    self.item_window.cursor_is_in = self.item_window.EQUIPMENT_RECT
-                    self.item_window.cursor_position = 0
-                elif self.item_window.cursor_position == 3 or self.item_window.cursor_position == 4:
-                    sounds["pi"].play()
-                    self.item_window.cursor_is_in = self.item_window.EQUIPMENT_RECT
-                    self.item_window.cursor_position = 1
-            elif self.item_window.cursor_is_in == self.item_window.EQUIPMENT_RECT:
-                if self.item_window.cursor_position == 4:
-                    pass
-                elif self.item_window.cursor_position == 5:
-                    pass
-                else:
-                    sounds["pi"].play()
-                    self.item_window.cursor_position += 2
-
-        elif event.type == KEYDOWN and event.key == K_SPACE:
-            if self.item_window.cursor_is_in == self.item_window.INVENTORY_RECT:
-                if self.item_window.is_grabbing:
-                    if not Player.inventory[self.item_window.cursor_position]:
-                        Player.inventory[self.item_window.cursor_position] = self.item_window.selected_item
-                        self.item_window.selected_item = None
-                        self.item_window.selected_item_position = None
-                        self.item_window.selected_item_from = None
-                        self.item_window.is_grabbing = False
-                else:
-                    if Player.inventory[self.item_window.cursor_position]:
-                        self.item_window.selected_item = Player.inventory[self.item_window.cursor_position]
-                        self.item_window.selected_item_position = self.item_window.cursor_position
-                        self.item_window.selected_item_from = self.item_window.INVENTORY_RECT
-                        Player.inventory[self.item_window.cursor_position] = None
-                        self.item_window.is_grabbing = True
-            elif self.item_window.cursor_is_in == self.item_window.DROP_RECT:
-                if self.item_window.is_grabbing:
-                    self.item_window.selected_item = None
-                    self.item_window.selected_item_position = None
-                    self.item_window.selected_item_from = None
-                    self.item_window.is_grabbing = False
-
-            elif self.item_window.cursor_is_in == self.item_window.BAG_RECT:
-                if self.item_window.is_grabbing:
-                    if not self.item_window.selected_player.bag[self.item_window.cursor_position]:
-                        self.item_window.selected_player.bag[self.item_window.cursor_position] = self.item_window.selected_item
-                        self.item_window.selected_item = None
-                        self.item_window.selected_item_position = None
-                        self.item_window.selected_item_from = None
-                        self.item_window.is_grabbing = False
-                else:
-                    if self.item_window.selected_player.bag[self.item_window.cursor_position]:
-                        self.item_window.selected_item = self.item_window.selected_player.bag[self.item_window.cursor_position]
-                        self.item_window.selected_player.bag[self.item_window.cursor_position] = None
-                        self.item_window.selected_item_position = self.item_window.cursor_position
-                        self.item_window.selected_item_from = self.item_window.BAG_RECT
-                        self.item_window.is_grabbing = True
-
-            elif self.item_window.cursor_is_in == self.item_window.EQUIPMENT_RECT:
-
-                # # equipments
-                # self.weapon = None
-                # self.head = None
-                # self.body = None
-                # self.arms = None
-                # self.legs = None
-                # self.boots = None
-                # self.accessory = None
-
-                if self.item_window.cursor_position == 0:  # weapon
-                    if self.item_window.is_grabbing:
-                        if not self.item_window.selected_player.weapon:
-                            self.item_window.selected_player.weapon = self.item_window.selected_item
-                            self.item_window.selected_item = None
-                            self.item_window.selected_item_position = None
-                            self.item_window.selected_item_from = None
-                            self.item_window.is_grabbing = False
-                    else:
-                        if self.item_window.selected_player.weapon:
-                            self.item_window.selected_item = self.item_window.selected_player.weapon
-                            self.item_window.selected_player.weapon = None
-                            self.item_window.selected_item_position = self.item_window.cursor_position
-                            self.item_window.selected_item_from = self.item_window.EQUIPMENT_RECT
-                            self.item_window.is_grabbing = True
-
-                elif self.item_window.cursor_position == 1:  # head
-                    if self.item_window.is_grabbing:
-                        if not self.item_window.selected_player.head:
-                            self.item_window.selected_player.head = self.item_window.selected_item
-                            self.item_window.selected_item = None
-                            self.item_window.selected_item_position = None
-                            self.item_window.selected_item_from = None
-                            self.item_window.is_grabbing = False
-                    else:
-                        if self.item_window.selected_player.head:
-                            self.item_window.selected_item = self.item_window.selected_player.head
-                            self.item_window.selected_player.head = None
-                            self.item_window.selected_item_position = self.item_window.cursor_position
-                            self.item_window.selected_item_from = self.item_window.EQUIPMENT_RECT
-                            self.item_window.is_grabbing = True
-                elif self.item_window.cursor_position == 2:  # accessory
-                    if self.item_window.is_grabbing:
-                        if not self.item_window.selected_player.accessory:
-                            self.item_window.selected_player.accessory = self.item_window.selected_item
-                            self.item_window.selected_item = None
-                            self.item_window.selected_item_position = None
-                            self.item_window.selected_item_from = None
-                            self.item_window.is_grabbing = False
-                    else:
-                        if self.item_window.selected_player.accessory:
-                            self.item_window.selected_item = self.item_window.selected_player.accessory
-                            self.item_window.selected_player.accessory = None
-                            self.item_window.selected_item_position = self.item_window.cursor_position
-                            self.item_window.selected_item_from = self.item_window.EQUIPMENT_RECT
-                            self.item_window.is_grabbing = True
-                elif self.item_window.cursor_position == 3:  # armor
-                    if self.item_window.is_grabbing:
-                        if not self.item_window.selected_player.body:
-                            self.item_window.selected_player.body = self.item_window.selected_item
-                            self.item_window.selected_item = None
-                            self.item_window.selected_item_position = None
-                            self.item_window.selected_item_from = None
-                            self.item_window.is_grabbing = False
-                    else:
-                        if self.item_window.selected_player.body:
-                            self.item_window.selected_item = self.item_window.selected_player.body
-                            self.item_window.selected_player.body = None
-                            self.item_window.selected_item_position = self.item_window.cursor_position
-                            self.item_window.selected_item_from = self.item_window.EQUIPMENT_RECT
-                            self.item_window.is_grabbing = True
-                elif self.item_window.cursor_position == 4:  # boots
-                    if self.item_window.is_grabbing:
-                        if not self.item_window.selected_player.boots:
-                            self.item_window.selected_player.boots = self.item_window.selected_item
-                            self.item_window.selected_item = None
-                            self.item_window.selected_item_position = None
-                            self.item_window.selected_item_from = None
-                            self.item_window.is_grabbing = False
-                    else:
-                        if self.item_window.selected_player.boots:
-                            self.item_window.selected_item = self.item_window.selected_player.boots
-                            self.item_window.selected_player.boots = None
-                            self.item_window.selected_item_position = self.item_window.cursor_position
-                            self.item_window.selected_item_from = self.item_window.EQUIPMENT_RECT
-                            self.item_window.is_grabbing = True
-                elif self.item_window.cursor_position == 5:  # hand
-                    if self.item_window.is_grabbing:
-                        if not self.item_window.selected_player.arms:
-                            self.item_window.selected_player.arms = self.item_window.selected_item
-                            self.item_window.selected_item = None
-                            self.item_window.selected_item_position = None
-                            self.item_window.selected_item_from = None
-                            self.item_window.is_grabbing = False
-                    else:
-                        if self.item_window.selected_player.arms:
-                            self.item_window.selected_item = self.item_window.selected_player.arms
-                            self.item_window.selected_player.arms = None
-                            self.item_window.selected_item_position = self.item_window.cursor_position
-                            self.item_window.selected_item_from = self.item_window.EQUIPMENT_RECT
-                            self.item_window.is_grabbing = True
+                self.item_window.selected_item_from = None
+                self.item_window.is_grabbing = False
+        elif self.item_window.is_grabbing:
+            if not self.item_window.get_slot():
+                self.item_window.set_slot(self.item_window.selected_item)
+                self.item_window.selected_item = None
+                self.item_window.selected_item_position = None
+                self.item_window.selected_item_from = None
+                self.item_window.is_grabbing = False
+        else:
+            item = self.item_window.get_slot()
+            if item:
+                self.item_window.selected_item = item
+                self.item_window.set_slot(None)
+                self.item_window.selected_item_position = self.item_window.cursor_position
+                self.item_window.selected_item_from = self.item_window.cursor_is_in
+                self.item_window.is_grabbing = True
+        self.item_window.invalidate_item_layer()
 
     def shop_window_handler(self, event):
         global game_state
@@ -557,7 +861,6 @@ class pyRPG:
             self.shop_window.cursor_in_shop_shelf = True
             game_state = FILLED
             self.map.play_bgm()
-            self.map.play_bgm()
         if event.type == KEYDOWN and event.key == K_UP:
             if not self.shop_window.cursor_in_shop_shelf:
                 if self.shop_window.cursor_position - 5 >= 0:
@@ -706,9 +1009,11 @@ class pyRPG:
                         Player.inventory[self.shop_window.cursor_position] = None
                         self.shop_window.is_grabbing = True
                         self.shop_window.is_grabbing_product = False
+            self.shop_window.invalidate_item_layer()
 
         elif event.type == KEYDOWN and event.key == K_c:
             Player.inventory[0] = Item("agl", "test", 100)
+            self.shop_window.invalidate_item_layer()
 
     def battle_command_handler(self, event):
         global game_state
@@ -750,6 +1055,7 @@ class pyRPG:
         else:
             if event.type == KEYDOWN and event.key == K_SPACE:
                 if self.battle.command_window.command == BattleCommandWindow.ESCAPE:
+                    self.battle.finish()
                     self.map.play_bgm()
                     self.battle.message_window.hide()
                     game_state = FILLED
@@ -808,88 +1114,103 @@ class pyRPG:
                 global game_state
                 game_state = COMMAND
 
+    def create_key_bindings(self):
+        # what each key or command does in the windows, resolved by a dict lookup
+        self.command_actions = {
+            CommandWindow.TALK: self.command_talk,
+            CommandWindow.STATUS: self.command_status,
+            CommandWindow.EQUIPMENT: self.command_equipment,
+            CommandWindow.DOOR: self.command_door,
+            CommandWindow.SPELL: self.command_spell,
+            CommandWindow.ITEM: self.command_item,
+            CommandWindow.SEARCH: self.command_search,
+        }
+        self.item_window_keys = {
+            K_q: self.close_item_window,
+            K_SPACE: self.grab_item,
+        }
+        self.player_status_window_keys = {
+            K_d: self.next_status_page,
+            K_a: self.previous_status_page,
+            K_q: self.close_player_status_window,
+            K_SPACE: self.toggle_points_distribution,
+            K_LEFT: self.remove_status_point,
+            K_RIGHT: self.add_status_point,
+            K_UP: self.previous_status,
+            K_DOWN: self.next_status,
+        }
+
     def command_window_handler(self, event):
+        if event.type != KEYDOWN:
+            return
+        move = CommandWindow.NAVIGATION.move(self.command_window.command, event.key)
+        if move:
+            self.command_window.command = move[0]
+        elif event.key == K_SPACE:
+            action = self.command_actions.get(self.command_window.command)
+            if action:
+                sounds["pi"].play()
+                self.command_window.hide()
+                action()
+
+    def command_talk(self):
         global game_state
-        player = self.party.members[0]
+        character = self.party.members[0].talk(self.map)
+        if character:
+            if isinstance(character, Clerk):
+                self.shop_window.set_clerk(character)
+                game_state = SHOP
+                self.shop_window.play_bgm()
+            else:
+                self.message_window.set_message(character.message)
+                game_state = TALK
+        else:
+            self.message_window.set_message("There's no one there")
+            game_state = TALK
 
-        if event.type == KEYDOWN:
-            if event.key == K_LEFT:
-                if self.command_window.command <= 3:
-                    return
-                self.command_window.command -= 4
-            elif event.key == K_RIGHT:
-                if self.command_window.command >= 4:
-                    return
-                self.command_window.command += 4
-            elif event.key == K_UP:
-                if self.command_window.command == 0 or self.command_window.command == 4:
-                    return
-                self.command_window.command -= 1
-            elif event.key == K_DOWN:
-                if self.command_window.command == 3 or self.command_window.command == 7:
-                    return
-                self.command_window.command += 1
+    def command_status(self):
+        global game_state
+        self.player_status_window.show()
+        game_state = STATUS
+        self.player_status_window.play_bgm()
 
-            if event.key == K_SPACE:
-                if self.command_window.command == CommandWindow.TALK:
-                    sounds["pi"].play()
-                    self.command_window.hide()
-                    character = player.talk(self.map)
-                    if character:
-                        if isinstance(character, Clerk):
-                            self.shop_window.set_clerk(character)
-                            game_state = SHOP
-                            self.shop_window.play_bgm()
-                        else:
-                            self.message_window.set_message(character.message)
-                            game_state = TALK
-                    else:
-                        self.message_window.set_message("There's no one there")
-                        game_state = TALK
-                elif self.command_window.command == CommandWindow.STATUS:
-                    sounds["pi"].play()
-                    self.command_window.hide()
-                    self.player_status_window.show()
-                    game_state = STATUS
-                    self.player_status_window.play_bgm()
-                elif self.command_window.command == CommandWindow.EQUIPMENT:
-                    sounds["pi"].play()
-                    self.command_window.hide()
-                    self.message_window.set_message("should show the equipment of the player")
-                    game_state = TALK
-                elif self.command_window.command == CommandWindow.DOOR:
-                    sounds["pi"].play()
-                    self.command_window.hide()
-                    door = player.open(self.map)
-                    if door:
-                        door.open()
-                        self.map.remove_event(door)
-                        game_state = FILLED
-                    else:
-                        self.message_window.set_message("There's no door there")
-                        game_state = TALK
-                elif self.command_window.command == CommandWindow.SPELL:
-                    sounds["pi"].play()
-                    self.command_window.hide()
-                    self.message_window.set_message("Should open a window for spells")
-                    game_state = TALK
-                elif self.command_window.command == CommandWindow.ITEM:
-                    sounds["pi"].play()
-                    self.command_window.hide()
-                    self.item_window.show()
-                    game_state = ITEM
-                elif self.command_window.command == CommandWindow.SEARCH:
-                    sounds["pi"].play()
-                    self.command_window.hide()
-                    treasure = player.search(self.map)
-                    if treasure:
-                        treasure.open()
-                        self.message_window.set_message("get "+treasure.item)
-                        game_state = TALK
-                        self.map.remove_event(treasure)
-                    else:
-                        self.message_window.set_message("didn't find anything")
-                        game_state = TALK
+    def command_equipment(self):
+        global game_state
+        self.message_window.set_message("should show the equipment of the player")
+        game_state = TALK
+
+    def command_door(self):
+        global game_state
+        door = self.party.members[0].open(self.map)
+        if door:
+            door.open()
+            self.map.remove_event(door)
+            game_state = FILLED
+        else:
+            self.message_window.set_message("There's no door there")
+            game_state = TALK
+
+    def command_spell(self):
+        global game_state
+        self.message_window.set_message("Should open a window for spells")
+        game_state = TALK
+
+    def command_item(self):
+        global game_state
+        self.item_window.show()
+        game_state = ITEM
+
+    def command_search(self):
+        global game_state
+        treasure = self.party.members[0].search(self.map)
+        if treasure:
+            treasure.open()
+            self.message_window.set_message("get "+treasure.item)
+            game_state = TALK
+            self.map.remove_event(treasure)
+        else:
+            self.message_window.set_message("didn't find anything")
+            game_state = TALK
 
     def talk_handler(self, event):
         if event.type == KEYDOWN and event.key == K_SPACE:
@@ -904,83 +1225,96 @@ class pyRPG:
         # Author: Junhong Wang
         # Date: 2016/11/11
         # Description: input handler for event window
-        if event.type == KEYDOWN and event.key == K_d:
-            if not self.player_status_window.page + 1 >= len(self.party.members) and not self.player_status_window.points_distribution_flag:
-                sounds["pi"].play()
-                self.player_status_window.page += 1
-        elif event.type == KEYDOWN and event.key == K_a:
-            if not self.player_status_window.page - 1 < 0 and not self.player_status_window.points_distribution_flag:
+        if event.type != KEYDOWN:
+            return
+        if not self.player_status_window.points_distribution_flag:
+            move = PlayerStatusWindow.NAVIGATION.move(self.player_status_window.selection, event.key)
+            if move:
                 sounds["pi"].play()
-                self.player_status_window.page -= 1
-        elif event.type == KEYDOWN and event.key == K_q:
+                self.player_status_window.selection = move[0]
+                return
+        action = self.player_status_window_keys.get(event.key)
+        if action:
+            action()
+
+    def next_status_page(self):
+        if not self.player_status_window.page + 1 >= len(self.party.members) and not self.player_status_window.points_distribution_flag:
             sounds["pi"].play()
-            if self.player_status_window.points_distribution_flag:
-                self.player_status_window.points_distribution_flag = False
-                self.player_status_window.status_cursor_position = 0
-            else:
-                self.player_status_window.selection = self.player_status_window.STATUS_WINDOW
-                self.player_status_window.page = 0
-                global game_state
-                game_state = FILLED
-                self.map.play_bgm()
-        elif event.type == KEYDOWN and event.key == K_LEFT:
-            if not self.player_status_window.selection == self.player_status_window.STATUS_WINDOW \
-                    and not self.player_status_window.points_distribution_flag:
+            self.player_status_window.select_page(self.player_status_window.page + 1)
+
+    def previous_status_page(self):
+        if not self.player_status_window.page - 1 < 0 and not self.player_status_window.points_distribution_flag:
+            sounds["pi"].play()
+            self.player_status_window.select_page(self.player_status_window.page - 1)
+
+    def close_player_status_window(self):
+        sounds["pi"].play()
+        if self.player_status_window.points_distribution_flag:
+            self.player_status_window.points_distribution_flag = False
+            self.player_status_window.status_cursor_position = 0
+            self.player_status_window.select_page(self.player_status_window.page)
+        else:
+            self.player_status_window.selection = self.player_status_window.STATUS_WINDOW
+            self.player_status_window.select_page(0)
+            global game_state
+            game_state = FILLED
+            self.map.play_bgm()
+
+    def remove_status_point(self):
+        if self.player_status_window.points_distribution_flag and self.player_status_window.selection \
+                == self.player_status_window.STATUS_WINDOW:
+            if self.player_status_window.status_after[self.player_status_window.status_cursor_position] - 1 \
+                    >= self.player_status_window.status_before[self.player_status_window.status_cursor_position]:
                 sounds["pi"].play()
-                self.player_status_window.selection = self.player_status_window.STATUS_WINDOW
-            elif self.player_status_window.points_distribution_flag and self.player_status_window.selection \
-                    == self.player_status_window.STATUS_WINDOW:
-                if self.player_status_window.status_after[self.player_status_window.status_cursor_position] - 1 \
-                        >= self.player_status_window.status_before[self.player_status_window.status_cursor_position]:
-                    sounds["pi"].play()
-                    self.player_status_window.status_after[self.player_status_window.status_cursor_position] -= 1
-                    self.player_status_window.selected_player.status_points += 1
-        elif event.type == KEYDOWN and event.key == K_RIGHT:
-            if not self.player_status_window.selection == self.player_status_window.SKILLS_WINDOW \
-                    and not self.player_status_window.points_distribution_flag:
+                self.player_status_window.status_after[self.player_status_window.status_cursor_position] -= 1
+                self.player_status_window.selected_player.status_points += 1
+
+    def add_status_point(self):
+        if self.player_status_window.points_distribution_flag and self.player_status_window.selection \
+                == self.player_status_window.STATUS_WINDOW:
+            if self.player_status_window.selected_player.status_points > 0:
+                sounds["pi"].play()
+                self.player_status_window.status_after[self.player_status_window.status_cursor_position] += 1
+                self.player_status_window.selected_player.status_points -= 1
+
+    def toggle_points_distribution(self):
+        sounds["pi"].play()
+        if self.player_status_window.points_distribution_flag:
+            # hp, atk, int, de, mgr, agi, cri, exe
+            self.player_status_window.selected_player.health = self.player_status_window.status_after[0]
+            self.player_status_window.selected_player.attack = self.player_status_window.status_after[1]
+            self.player_status_window.selected_player.intelligence = self.player_status_window.status_after[2]
+            self.player_status_window.selected_player.defence = self.player_status_window.status_after[3]
+            self.player_status_window.selected_player.magic_resistance = self.player_status_window.status_after[4]
+            self.player_status_window.selected_player.agility = self.player_status_window.status_after[5]
+            self.player_status_window.selected_player.critical_hit = self.player_status_window.status_after[6]
+            self.player_status_window.selected_player.experience = self.player_status_window.status_after[7]
+            self.player_status_window.select_page(self.player_status_window.page)
+        self.player_status_window.points_distribution_flag = not self.player_status_window.points_distribution_flag
+        self.player_status_window.status_cursor_position = 0
+
+    def previous_status(self):
+        if self.player_status_window.points_distribution_flag:
+            if not self.player_status_window.status_cursor_position - 1 < 0:
                 sounds["pi"].play()
-                self.player_status_window.selection = self.player_status_window.SKILLS_WINDOW
-            elif self.player_status_window.points_distribution_flag and self.player_status_window.selection \
-                    == self.player_status_window.STATUS_WINDOW:
-                if self.player_status_window.selected_player.status_points > 0:
+                self.player_status_window.status_cursor_position -= 1
+
+    def next_status(self):
+        if self.player_status_window.points_distribution_flag:
+            if self.player_status_window.selection == self.player_status_window.STATUS_WINDOW:
+                if not self.player_status_window.status_cursor_position + 1 >= len(self.player_status_window.STATUS):
                     sounds["pi"].play()
-                    self.player_status_window.status_after[self.player_status_window.status_cursor_position] += 1
-                    self.player_status_window.selected_player.status_points -= 1
-        elif event.type == KEYDOWN and event.key == K_SPACE:
-            sounds["pi"].play()
-            if self.player_status_window.points_distribution_flag:
-                # hp, atk, int, de, mgr, agi, cri, exe
-                self.player_status_window.selected_player.health = self.player_status_window.status_after[0]
-                self.player_status_window.selected_player.attack = self.player_status_window.status_after[1]
-                self.player_status_window.selected_player.intelligence = self.player_status_window.status_after[2]
-                self.player_status_window.selected_player.defence = self.player_status_window.status_after[3]
-                self.player_status_window.selected_player.magic_resistance = self.player_status_window.status_after[4]
-                self.player_status_window.selected_player.agility = self.player_status_window.status_after[5]
-                self.player_status_window.selected_player.critical_hit = self.player_status_window.status_after[6]
-                self.player_status_window.selected_player.experience = self.player_status_window.status_after[7]
-            self.player_status_window.points_distribution_flag = not self.player_status_window.points_distribution_flag
-            self.player_status_window.status_cursor_position = 0
-        elif event.type == KEYDOWN and event.key == K_UP:
-            if self.player_status_window.points_distribution_flag:
-                if not self.player_status_window.status_cursor_position - 1 < 0:
+                    self.player_status_window.status_cursor_position += 1
+            elif self.player_status_window.selection == self.player_status_window.SKILLS_WINDOW:
+                if not self.player_status_window.status_cursor_position + 1 >= len(self.player_status_window.party.members[self.player_status_window.page].skills):
                     sounds["pi"].play()
-                    self.player_status_window.status_cursor_position -= 1
-        elif event.type == KEYDOWN and event.key == K_DOWN:
-            if self.player_status_window.points_distribution_flag:
-                if self.player_status_window.selection == self.player_status_window.STATUS_WINDOW:
-                    if not self.player_status_window.status_cursor_position + 1 >= len(self.player_status_window.STATUS):
-                        sounds["pi"].play()
-                        self.player_status_window.status_cursor_position += 1
-                elif self.player_status_window.selection == self.player_status_window.SKILLS_WINDOW:
-                    if not self.player_status_window.status_cursor_position + 1 >= len(self.player_status_window.party.members[self.player_status_window.page].skills):
-                        sounds["pi"].play()
-                        self.player_status_window.status_cursor_position += 1
-
-    def calculate_offsets(self, player):
+                    self.player_status_window.status_cursor_position += 1
+
+    def calculate_offsets(self, position):
         # calculate the offsets respect to the player position
         # this will be used to convert world coordinates to screen coordinates
-        offset_x = player.rect.topleft[0] - SCREEN_RECT.width / 2
-        offset_y = player.rect.topleft[1] - SCREEN_RECT.height / 2
+        offset_x = position[0] - SCREEN_RECT.width / 2
+        offset_y = position[1] - SCREEN_RECT.height / 2
         return offset_x, offset_y
 
     def show_info(self):
@@ -989,13 +1323,17 @@ class pyRPG:
         self.message_engine.draw(self.screen, player.name.upper(), (450, 40))
         player_position_info = str(player.x) + ' ' + str(player.y)
         self.message_engine.draw(self.screen, player_position_info, (450, 70))
+        info = (self.map.name, player.name, player_position_info)
+        if info != self.drawn_info:
+            mark_dirty(Rect(450, 10, SCREEN_RECT.width - 450, 90))
+            self.drawn_info = info
 
     def load_items(self, directory, file_name):
         # Author: Junhong Wang
         # Date: 11/19/2016
         # Description: load items and store them in Shop class
         file_path = os.path.join(directory, file_name)
-        file = open(file_path)
+        file = assets.open_file(file_path)
         for line in file:
             line = line.rstrip()
             if line.startswith("#"):
@@ -1014,18 +1352,14 @@ class pyRPG:
         file.close()
 
     def load_sounds(self, directory):
-        sound_file_name_list = os.listdir(directory)
-        print(sound_file_name_list)
-        if ".DS_Store" in sound_file_name_list:
-            sound_file_name_list.remove(".DS_Store")
-        for file_name in sound_file_name_list:
-            sound_file_path = os.path.join(directory, file_name)
-            sounds[file_name[:-4]] = pygame.mixer.Sound(sound_file_path)
-            sounds[file_name[:-4]].set_volume(0.01)
+        # the sounds are decoded when they are played first, except the ones warmed up during the title
+        sounds.register(directory)
+        sounds.warm_up(SoundRegistry.WARM_UP)
 
     def load_character_chips(self, directory, file_name):
         file_path = os.path.join(directory, file_name)
-        file = open(file_path)
+        file = assets.open_file(file_path)
+        character_names = []
         for line in file:
             line = line.rstrip()
             if line.startswith("#"):
@@ -1035,12 +1369,19 @@ class pyRPG:
             character_name = data[1]
             row = int(data[2])
             column = int(data[3])
-            Character.images[character_name] = split_image(load_image("charachip", character_name + ".png"), TILE_SIZE)
+            character_names.append(character_name)
         file.close()
 
+        # pack the sheets into the atlas and forget the separate images
+        Character.atlas.pack({name: load_image("charachip", name + ".png", "atlas") for name in character_names})
+        for character_name in character_names:
+            Character.images[character_name] = split_image(Character.atlas.get(character_name), TILE_SIZE)
+        assets.unload("atlas")
+
     def load_map_chips(self, directory, file_name):
         file_path = os.path.join(directory, file_name)
-        file = open(file_path)
+        file = assets.open_file(file_path)
+        map_chip_names = []
         for line in file:
             line = line.rstrip()
             if line.startswith("#"):
@@ -1049,14 +1390,20 @@ class pyRPG:
             map_chip_id = int(data[0])
             map_chip_name = data[1]
             movable = int(data[2])
-            Map.images.append(load_image("mapchip", map_chip_name + ".png"))
+            map_chip_names.append(map_chip_name)
             Map.movable_type.append(movable)
         file.close()
 
+        # pack the map chips into the atlas and forget the separate images
+        Map.atlas.pack({name: load_image("mapchip", name + ".png", "atlas") for name in map_chip_names})
+        for map_chip_name in map_chip_names:
+            Map.images.append(Map.atlas.get(map_chip_name))
+        assets.unload("atlas")
+
     def load_enemy_batch(self, directory, file_name):
         # id, name, health, attack, intelligence, defence, magic_resistance, agility, critical_hit, experience
         file_path = os.path.join(directory, file_name)
-        file = open(file_path)
+        file = assets.open_file(file_path)
         for line in file:
             line = line.rstrip()
             if line.startswith('#'):
@@ -1073,39 +1420,81 @@ class pyRPG:
             agility = data[7]
             critical_hit = data[8]
             experience = data[9]
-            Map.enemy_batch.append(Enemy(id, name, mana, health, attack, intelligence, defence, magic_resistance, agility, critical_hit, experience))
+            Map.enemy_batch.append(EnemyTemplate(id, name, mana, health, attack, intelligence, defence, magic_resistance, agility, critical_hit, experience))
         file.close()
 
 
 class Map:
 
-    images = []
+    atlas = TextureAtlas(256)  # every map chip fits in one sheet
+    images = []  # views of the atlas
     movable_type = []
 
     enemy_batch = []
 
     default = 1  # default map chip id
 
+    HEADER_FORMAT = "iiB"  # row, column, default map chip id
+    MMAP_SIZE = 1 << 20  # [byte], map files larger than this are memory mapped instead of read
+    MAX_CHUNKS = 16  # pre-rendered chunks kept in memory
+
     def __init__(self, directory, name, party):
-        self.name = name
-        self.row = 0
-        self.column = 0
-        self.map = []
-        self.characters = []
-        self.enemies = []
-        self.events = []
+        self.map = None
         self.bgm_file_path = None
         self.party = party
-        self.load(directory)
-        self.load_event(directory)
+        self.preloader = MapPreloader()
+        # the music of the map starts when the player enters it from the title
+        self.activate(directory, self.read(directory, name), False)
+
+    @classmethod
+    def read(cls, directory, name):
+        # parse the files of the map into a map that is not active yet
+        # nothing here touches pygame.mixer, so the preloader thread can call it
+        map = cls.__new__(cls)
+        map.name = name
+        map.row = 0
+        map.column = 0
+        map.map = bytearray()
+        map.chunks = OrderedDict()  # { (chunk_x, chunk_y): pre-rendered surface }, least recently drawn first
+        map.prefetched = None
+        map.characters = []
+        map.enemies = []  # [(enemy template, level)]
+        map.events = []
+        # number of characters and events blocking each tile, row-major,
+        # only the blocked tiles are counted for a world that may not fit in memory
+        map.blocked = bytearray()
+        map.character_index = {}  # { (x, y): [characters] }
+        map.event_index = {}  # { (x, y): [events] }
+        map.bgm_file_path = None
+        map.load(directory)
+        map.load_event(directory)
+        map.build_index()
+        return map
 
     def create(self, directory, destination_map):
-        self.name = destination_map
-        self.characters = []
-        self.enemies = []
-        self.events = []
-        self.load(directory)
-        self.load_event(directory)
+        # the destination has usually been parsed in the background already
+        state = self.preloader.take(directory, destination_map)
+        if state is None:
+            state = self.read(directory, destination_map)
+        self.activate(directory, state)
+
+    def activate(self, directory, state, entered=True):
+        # switch to the parsed map by taking over its attributes
+        if isinstance(self.map, World):
+            self.map.close()
+        bgm_file_path = self.bgm_file_path
+        self.__dict__.update(state.__dict__)
+        mark_dirty(SCREEN_RECT)
+        if self.bgm_file_path:
+            if entered:
+                self.play_bgm()
+        else:
+            self.bgm_file_path = bgm_file_path  # keep playing the music of the previous map
+
+        # parse the maps the player can move to next
+        for event in self.events:
+            if isinstance(event, MoveEvent):
+                self.preloader.preload(directory, event.destination_map)
 
     def input(self):
         for character in self.characters:
@@ -1117,17 +1506,12 @@ class Map:
 
     def draw(self, screen, offsets):
         offset_x, offset_y = offsets
-        #  calculate which parts of the map should be drawn (camera culling)
-        start_x = int(offset_x / TILE_SIZE) - 1
-        end_x = start_x + int(SCREEN_RECT.width/TILE_SIZE) + 2
-        start_y = int(offset_y / TILE_SIZE) - 1
-        end_y = start_y + int(SCREEN_RECT.height/TILE_SIZE) + 2
-        for y in range(start_y, end_y):
-            for x in range(start_x, end_x):
-                if x < 0 or y < 0 or x > self.column-1 or y > self.row-1:
-                    screen.blit(self.images[self.default], (x*TILE_SIZE-offset_x, y*TILE_SIZE-offset_y))
-                else:
-                    screen.blit(self.images[self.map[y][x]], (x*TILE_SIZE-offset_x, y*TILE_SIZE-offset_y))
+        chunk_pixels = CHUNK_SIZE*TILE_SIZE
+        start_x, end_x, start_y, end_y = self.get_visible_chunks(offsets)
+        for chunk_y in range(start_y, end_y+1):
+            for chunk_x in range(start_x, end_x+1):
+                screen.blit(self.get_chunk(chunk_x, chunk_y),
+                            (chunk_x*chunk_pixels-offset_x, chunk_y*chunk_pixels-offset_y))
 
         for event in self.events:
             event.draw(screen, offsets)
@@ -1135,18 +1519,74 @@ class Map:
         for character in self.characters:
             character.draw(screen, offsets)
 
+    def get_visible_chunks(self, offsets):
+        #  calculate which chunks should be drawn (camera culling)
+        #  at most 4 chunks overlap the screen since a chunk is not smaller than the screen
+        offset_x, offset_y = offsets
+        chunk_pixels = CHUNK_SIZE*TILE_SIZE
+        start_x = int(offset_x // chunk_pixels)
+        end_x = int((offset_x + SCREEN_RECT.width - 1) // chunk_pixels)
+        start_y = int(offset_y // chunk_pixels)
+        end_y = int((offset_y + SCREEN_RECT.height - 1) // chunk_pixels)
+        return start_x, end_x, start_y, end_y
+
+    def get_chunk(self, chunk_x, chunk_y):
+        # the map chips never change while the map is loaded,
+        # so each chunk is rendered only once and reused while it stays near the camera
+        chunk = self.chunks.get((chunk_x, chunk_y))
+        if chunk is None:
+            chunk = self.render_chunk(chunk_x, chunk_y)
+            self.chunks[(chunk_x, chunk_y)] = chunk
+            if len(self.chunks) > self.MAX_CHUNKS:
+                self.chunks.popitem(last=False)
+        else:
+            self.chunks.move_to_end((chunk_x, chunk_y))
+        return chunk
+
+    def prefetch(self, offsets, direction):
+        # read the tiles of the chunks that come into the screen next while the leader is walking
+        if not isinstance(self.map, World):
+            return
+        start_x, end_x, start_y, end_y = self.get_visible_chunks(offsets)
+        if direction == DOWN:
+            start_y = end_y = end_y + 1
+        elif direction == LEFT:
+            start_x = end_x = start_x - 1
+        elif direction == RIGHT:
+            start_x = end_x = end_x + 1
+        elif direction == UP:
+            start_y = end_y = start_y - 1
+        chunks = (start_x, end_x, start_y, end_y)
+        if chunks == self.prefetched:
+            return
+        self.prefetched = chunks
+        for chunk_y in range(start_y, end_y+1):
+            for chunk_x in range(start_x, end_x+1):
+                self.map.prefetch(chunk_x*CHUNK_SIZE, chunk_y*CHUNK_SIZE)
+
+    def render_chunk(self, chunk_x, chunk_y):
+        chunk = pygame.Surface((CHUNK_SIZE*TILE_SIZE, CHUNK_SIZE*TILE_SIZE)).convert()
+        start_x = chunk_x*CHUNK_SIZE
+        start_y = chunk_y*CHUNK_SIZE
+        # the map chips are views of the same atlas sheet, so draw them in one batch
+        blit_sequence = []
+        for y in range(start_y, start_y+CHUNK_SIZE):
+            for x in range(start_x, start_x+CHUNK_SIZE):
+                position = ((x-start_x)*TILE_SIZE, (y-start_y)*TILE_SIZE)
+                #  some map chips (e.g. tree) are transparent, so put the default map chip under them
+                blit_sequence.append((self.images[self.default], position))
+                if 0 <= x < self.column and 0 <= y < self.row:
+                    blit_sequence.append((self.images[self.map[y*self.column + x]], position))
+        chunk.blits(blit_sequence, doreturn=False)
+        return chunk
+
     def is_movable(self, x, y):
         if x < 0 or x > self.column - 1 or y < 0 or y > self.row - 1:
             return False
-        if self.movable_type[self.map[y][x]] == 0:
+        if self.movable_type[self.map[y*self.column + x]] == 0:
+            return False
+        if self.blocked[y*self.column + x]:
             return False
-        for character in self.characters:
-            if character.x == x and character.y == y:
-                return False
-        for event in self.events:
-            if self.movable_type[event.map_chip_id] == 0:
-                if event.x == x and event.y == y:
-                    return False
 
         player = self.party.members[0]
         if player.x == x and player.y == y:
@@ -1156,7 +1596,7 @@ class Map:
 
     def load_event(self, directory):
         file_path = os.path.join(directory, self.name+".evt")
-        file = open(file_path, encoding='utf8')
+        file = assets.open_file(file_path, encoding='utf8')
         for line in file:
             line = line.rstrip()  # remove new line
             if line.startswith("#"):
@@ -1167,8 +1607,8 @@ class Map:
                 self.create_character(data)
             elif event_type == "MOVE":
                 self.create_move_event(data)
-            elif event_type == "BGM":  # background music
-                self.play_bgm(data)
+            elif event_type == "BGM":  # background music, played when the map is activated
+                self.bgm_file_path = os.path.join("bgm", data[1]+".ogg")
             elif event_type == "TREASURE":
                 self.create_treasure_event(data)
             elif event_type == "DOOR":
@@ -1181,16 +1621,8 @@ class Map:
                 self.create_clerk_event(data)
         file.close()
 
-    def play_bgm(self, data=None):
-
-        if data:
-            bgm_file_name = data[1]+".ogg"
-            self.bgm_file_path = os.path.join("bgm", bgm_file_name)
-            pygame.mixer.music.load(self.bgm_file_path)
-            pygame.mixer.music.play(-1)  # loop
-        else:
-            pygame.mixer.music.load(self.bgm_file_path)
-            pygame.mixer.music.play(-1)
+    def play_bgm(self):
+        music.play(self.bgm_file_path)
 
     def create_treasure_event(self, data):
         x, y = int(data[1]), int(data[2])
@@ -1243,44 +1675,250 @@ class Map:
     def create_enemy(self, data):
         id = int(data[1])
         level = int(data[2])
-        enemy = self.enemy_batch[id]
-        enemy.set_level(level)
-        self.enemies.append(enemy)
+        self.enemies.append((self.enemy_batch[id], level))
 
     def get_character(self, x, y):
-        for character in self.characters:
-            if character.x == x and character.y == y:
-                return character
-        return None
+        characters = self.character_index.get((x, y))
+        return characters[0] if characters else None
 
     def get_event(self, x, y):
+        events = self.event_index.get((x, y))
+        return events[0] if events else None
+
+    def build_index(self):
+        # index the characters and the events by tile so that the lookups don't scan them
+        self.blocked = Counter() if isinstance(self.map, World) else bytearray(self.row*self.column)
+        self.character_index = {}
+        self.event_index = {}
+        for character in self.characters:
+            self.add_character_index(character)
         for event in self.events:
-            if event.x == x and event.y == y:
-                return event
-        return None
+            self.event_index.setdefault((event.x, event.y), []).append(event)
+            if self.movable_type[event.map_chip_id] == 0:
+                self.block(event.x, event.y, 1)
+
+    def block(self, x, y, count):
+        if 0 <= x < self.column and 0 <= y < self.row:
+            index = y*self.column + x
+            self.blocked[index] += count
+            if not self.blocked[index] and isinstance(self.blocked, Counter):
+                del self.blocked[index]
+
+    def add_character_index(self, character):
+        self.character_index.setdefault((character.x, character.y), []).append(character)
+        self.block(character.x, character.y, 1)
+
+    def remove_character_index(self, character, x, y):
+        characters = self.character_index[(x, y)]
+        characters.remove(character)
+        if not characters:
+            del self.character_index[(x, y)]
+        self.block(x, y, -1)
+
+    def move_character(self, character, x, y):
+        # called when the character has finished moving from (x, y)
+        self.remove_character_index(character, x, y)
+        self.add_character_index(character)
 
     def load(self, directory):
         file_path = os.path.join(directory, self.name+".map")
-        file = open(file_path, "rb")  # open with binary format
-        self.row = struct.unpack("i", file.read(struct.calcsize("i")))[0]
-        self.column = struct.unpack("i", file.read(struct.calcsize("i")))[0]
-        self.default = struct.unpack("B", file.read(struct.calcsize("B")))[0]
-
-        self.map = [[4 for c in range(self.column)] for r in range(self.row)]
-        for r in range(self.row):
-            for c in range(self.column):
-                self.map[r][c] = struct.unpack("B", file.read(struct.calcsize("B")))[0]
-        file.close()
+        world_file_path = os.path.join(directory, self.name+".wld")
+        if os.path.exists(world_file_path) and \
+                (not os.path.exists(file_path) or os.path.getmtime(world_file_path) >= os.path.getmtime(file_path)):
+            # the tiles of the converted world are read chunk by chunk while walking around
+            self.map = World(world_file_path)
+            self.row, self.column, self.default = self.map.row, self.map.column, self.map.default
+            return
+
+        header_size = struct.calcsize(self.HEADER_FORMAT)
+        packed = assets.pack.read_file(file_path) if assets.pack else None
+        if packed is not None:
+            # the map is used right from the memory mapped pack
+            self.row, self.column, self.default = struct.unpack_from(self.HEADER_FORMAT, packed)
+            size = self.row*self.column
+            self.map = packed[header_size:header_size+size]
+            if len(self.map) < size:
+                raise ValueError("%s is broken: %d of %d tiles" % (file_path, len(self.map), size))
+            return
+
+        with open(file_path, "rb") as file:  # open with binary format
+            self.row, self.column, self.default = struct.unpack(self.HEADER_FORMAT, file.read(header_size))
+            size = self.row*self.column
+            # the map chip ids are stored row-major, one byte per tile: map chip id of (x, y) is self.map[y*column + x]
+            if size > self.MMAP_SIZE:
+                tiles = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))[header_size:header_size+size]
+                count = len(tiles)
+            else:
+                tiles = bytearray(size)
+                count = file.readinto(tiles)
+        if count < size:
+            raise ValueError("%s is broken: %d of %d tiles" % (file_path, count, size))
+        self.map = tiles
 
     def remove_event(self, event):
         self.events.remove(event)
+        events = self.event_index[(event.x, event.y)]
+        events.remove(event)
+        if not events:
+            del self.event_index[(event.x, event.y)]
+        if self.movable_type[event.map_chip_id] == 0:
+            self.block(event.x, event.y, -1)
+
+
+class MapPreloader:
+    # parses maps on a worker thread and keeps the ones ready to be activated
+    MAX_MAPS = 4
+
+    def __init__(self):
+        self.maps = OrderedDict()  # { (directory, name): parsed map }, least recently preloaded first
+        self.pending = set()
+        self.condition = threading.Condition()
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.preload_loop, daemon=True)
+        self.thread.start()
+
+    def preload(self, directory, name):
+        key = (directory, name)
+        with self.condition:
+            if key in self.maps or key in self.pending:
+                return
+            self.pending.add(key)
+        self.requests.put(key)
+
+    def preload_loop(self):
+        while True:
+            directory, name = self.requests.get()
+            map = None  # Map.create reads it again and raises the error in the main thread
+            try:
+                map = Map.read(directory, name)
+            except Exception as error:
+                print("Cannot preload map", name, error)
+            finally:
+                # take must wake up whatever happened
+                with self.condition:
+                    self.pending.discard((directory, name))
+                    if map:
+                        self.maps[(directory, name)] = map
+                        if len(self.maps) > self.MAX_MAPS:
+                            self.close(self.maps.popitem(last=False)[1])
+                    self.condition.notify_all()
+
+    def take(self, directory, name):
+        # the parsed map is handed over only once, so the map is fresh every time the player enters it
+        key = (directory, name)
+        with self.condition:
+            while key in self.pending:
+                self.condition.wait()
+            return self.maps.pop(key, None)
+
+    def close(self, map):
+        if isinstance(map.map, World):
+            map.map.close()
+
+
+class World:
+    # tiles of a map stored chunk by chunk (.wld) and read from the file around the camera
+    # it can be indexed like the tiles loaded from .map: map chip id of (x, y) is world[y*column + x]
+    MAGIC = b"WLD1"
+    HEADER_FORMAT = "<4siiBi"  # magic, row, column, default map chip id, chunk size
+    MAX_CHUNKS = 1024  # chunks of tiles kept in memory
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(file_path, "rb")
+        self.header_size = struct.calcsize(self.HEADER_FORMAT)
+        magic, self.row, self.column, self.default, self.chunk_size = \
+            struct.unpack(self.HEADER_FORMAT, self.file.read(self.header_size))
+        if magic != self.MAGIC:
+            self.file.close()
+            raise ValueError("%s is not a world file" % file_path)
+        self.chunk_columns = -(-self.column // self.chunk_size)
+        self.chunk_rows = -(-self.row // self.chunk_size)
+        self.chunks = OrderedDict()  # { (chunk_x, chunk_y): tiles }, least recently used first
+        # the file is shared with the prefetch thread
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.prefetch_loop, daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return self.row*self.column
+
+    def __getitem__(self, index):
+        y, x = divmod(index, self.column)
+        tiles = self.get_chunk(x // self.chunk_size, y // self.chunk_size)
+        return tiles[(y % self.chunk_size)*self.chunk_size + x % self.chunk_size]
+
+    def get_chunk(self, chunk_x, chunk_y):
+        with self.lock:
+            tiles = self.chunks.get((chunk_x, chunk_y))
+            if tiles is not None:
+                self.chunks.move_to_end((chunk_x, chunk_y))
+                return tiles
+            chunk_bytes = self.chunk_size*self.chunk_size
+            self.file.seek(self.header_size + (chunk_y*self.chunk_columns + chunk_x)*chunk_bytes)
+            tiles = self.file.read(chunk_bytes)
+            if len(tiles) < chunk_bytes:
+                raise ValueError("%s is broken: chunk %d %d is missing" % (self.file_path, chunk_x, chunk_y))
+            self.chunks[(chunk_x, chunk_y)] = tiles
+            if len(self.chunks) > self.MAX_CHUNKS:
+                self.chunks.popitem(last=False)
+            return tiles
+
+    def prefetch(self, x, y):
+        # read the chunk of the tile (x, y) in the background
+        if 0 <= x < self.column and 0 <= y < self.row:
+            self.requests.put((x // self.chunk_size, y // self.chunk_size))
+
+    def prefetch_loop(self):
+        while True:
+            chunk = self.requests.get()
+            if chunk is None:
+                return
+            try:
+                self.get_chunk(*chunk)
+            except ValueError:
+                pass  # the main thread reports it when the chunk is drawn
+            except Exception as error:
+                # keep serving the next requests
+                print("Cannot prefetch chunk", chunk, "of", self.file_path, error)
+
+    def close(self):
+        # the chunks still queued are not needed any more
+        while True:
+            try:
+                self.requests.get_nowait()
+            except queue.Empty:
+                break
+        self.requests.put(None)
+        self.thread.join()
+        self.file.close()
+
+    @classmethod
+    def convert(cls, map_file_path, world_file_path, chunk_size=CHUNK_SIZE):
+        # convert .map into .wld, reading one band of chunks at a time so that the whole map is never in memory
+        header_size = struct.calcsize(Map.HEADER_FORMAT)
+        with open(map_file_path, "rb") as map_file, open(world_file_path, "wb") as world_file:
+            row, column, default = struct.unpack(Map.HEADER_FORMAT, map_file.read(header_size))
+            world_file.write(struct.pack(cls.HEADER_FORMAT, cls.MAGIC, row, column, default, chunk_size))
+            chunk_columns = -(-column // chunk_size)
+            padding = bytes([default])*(chunk_columns*chunk_size - column)
+            for chunk_y in range(-(-row // chunk_size)):
+                band = map_file.read(min(chunk_size, row - chunk_y*chunk_size)*column)
+                lines = [band[r*column:(r+1)*column] + padding for r in range(len(band) // column)]
+                lines += [bytes([default])*(chunk_columns*chunk_size)]*(chunk_size - len(lines))
+                for chunk_x in range(chunk_columns):
+                    start = chunk_x*chunk_size
+                    world_file.write(b"".join(line[start:start+chunk_size] for line in lines))
 
 
 class Character:
     speed = 4  # [pixel per frame], should be factor of 36
     animation_cycle = 24  # the less, the faster
     frame = 0
-    images = {}
+    atlas = TextureAtlas(1024)
+    images = {}  # { name: frames }
+    alpha = 1.0  # how far the game loop is between the last step and the next one
 
     def __init__(self, name, nickname, row, column, position, direction, move_type, message):
         self.name = name
@@ -1290,6 +1928,7 @@ class Character:
         self.image = self.images[name][0]
         self.x, self.y = position[0], position[1]
         self.rect = self.image.get_rect(topleft=(self.x*TILE_SIZE, self.y*TILE_SIZE))
+        self.previous_position = self.rect.topleft  # before the last step
         self.velocity_x, self.velocity_y = 0, 0
         self.moving = False
         self.direction = direction
@@ -1302,8 +1941,10 @@ class Character:
             self.rect.move_ip(self.velocity_x, self.velocity_y)
             if self.rect.left % TILE_SIZE == 0 and self.rect.top % TILE_SIZE == 0:
                 self.moving = False
+                x, y = self.x, self.y
                 self.x = int(self.rect.left / TILE_SIZE)
                 self.y = int(self.rect.top / TILE_SIZE)
+                map.move_character(self, x, y)
             else:
                 return
 
@@ -1331,14 +1972,26 @@ class Character:
         #  animation
         self.image = self.images[self.name][self.direction*self.column + int(self.frame/self.animation_cycle) % self.column]
 
+    def save_position(self):
+        # should be called before each step of the simulation
+        self.previous_position = self.rect.topleft
+
+    def get_draw_position(self):
+        # position between the last two steps
+        previous_x, previous_y = self.previous_position
+        return (previous_x + round((self.rect.left - previous_x) * self.alpha),
+                previous_y + round((self.rect.top - previous_y) * self.alpha))
+
     def draw(self, screen, offsets):
         offset_x, offset_y = offsets
-        position_x, position_y = self.rect.topleft[0], self.rect.topleft[1]
-        screen.blit(self.image, (position_x-offset_x, position_y-offset_y))
+        position_x, position_y = self.get_draw_position()
+        rect = screen.blit(self.image, (position_x-offset_x, position_y-offset_y))
+        mark_changed(self, self.image, rect)
 
     def set_position(self, x, y, direction):
         self.x, self.y = x, y
         self.rect = self.image.get_rect(topleft=(self.x*TILE_SIZE, self.y*TILE_SIZE))
+        self.previous_position = self.rect.topleft
         self.direction = direction
 
 
@@ -1346,11 +1999,71 @@ class Item:
     # Author: Junhong Wang
     # Date: 2016/11/19
     # Description: none
+    MAX_ICON_BYTES = 256 * 1024  # [byte], icons kept in memory, the least recently drawn ones are unloaded first
+    atlas = TextureAtlas(256)
+    icons = OrderedDict()  # { item name: view of the atlas }
+    icon_bytes = 0
+    icon_lock = threading.Lock()
+    icon_requests = None  # names of the icons to load in the background
+    ICON_SIZE = 24  # [pixel]
+    placeholder = None  # drawn instead of the icons that cannot be loaded
+    missing_icons = set()
+
     def __init__(self, name, description, price):
         self.name = name
         self.description = description
         self.price = price
-        self.image = load_image("itemicon", name+".png")
+
+    @property
+    def image(self):
+        # the icon is not loaded until the item is drawn
+        return self.get_icon(self.name)
+
+    @staticmethod
+    def get_icon(name):
+        with Item.icon_lock:
+            icon = Item.icons.get(name)
+            if icon is not None:
+                Item.icons.move_to_end(name)
+                return icon
+            if name in Item.missing_icons:
+                return Item.placeholder
+            image = load_image("itemicon", name+".png", "icons")
+            if image is None:
+                Item.missing_icons.add(name)
+                if Item.placeholder is None:
+                    Item.placeholder = pygame.Surface((Item.ICON_SIZE, Item.ICON_SIZE), pygame.SRCALPHA, 32)
+                return Item.placeholder
+            # only the copy in the atlas is kept
+            icon = Item.atlas.add(name, image)
+            assets.release("itemicon", name+".png", "icons")
+            Item.icons[name] = icon
+            Item.icon_bytes += icon.get_width() * icon.get_height() * icon.get_bytesize()
+            while Item.icon_bytes > Item.MAX_ICON_BYTES and len(Item.icons) > 1:
+                old_name, old_icon = Item.icons.popitem(last=False)
+                Item.icon_bytes -= old_icon.get_width() * old_icon.get_height() * old_icon.get_bytesize()
+                Item.atlas.remove(old_name)
+            return icon
+
+    @staticmethod
+    def prefetch(items):
+        # load the icons of the items about to be shown in the background
+        if Item.icon_requests is None:
+            Item.icon_requests = queue.Queue()
+            threading.Thread(target=Item.prefetch_loop, daemon=True).start()
+        for item in items:
+            if item:
+                Item.icon_requests.put(item.name)
+
+    @staticmethod
+    def prefetch_loop():
+        while True:
+            name = Item.icon_requests.get()
+            try:
+                Item.get_icon(name)
+            except Exception as error:
+                # keep serving the next requests
+                print("Cannot prefetch icon", name, error)
 
 
 class Sword(Item):
@@ -1536,6 +2249,33 @@ class Player(Character):
         self.moving = True
 
 
+class NavigationGraph:
+    # cells of a menu and the cell each key moves the cursor to,
+    # declared once so that a key press is a single dict lookup
+
+    def __init__(self):
+        self.moves = {}  # { (cell, key): (cell, sound) }
+
+    def link(self, cell, key, target, sound=True):
+        self.moves[cell, key] = (target, sound)
+
+    def grid(self, rows, area=None, sound=True):
+        # link each cell of the rows to its neighbors,
+        # the cells are (area, position) when the menu has several areas
+        for y, row in enumerate(rows):
+            for x, position in enumerate(row):
+                cell = position if area is None else (area, position)
+                neighbors = {K_LEFT: (x - 1, y), K_RIGHT: (x + 1, y), K_UP: (x, y - 1), K_DOWN: (x, y + 1)}
+                for key, (nx, ny) in neighbors.items():
+                    if 0 <= ny < len(rows) and 0 <= nx < len(rows[ny]):
+                        target = rows[ny][nx] if area is None else (area, rows[ny][nx])
+                        self.link(cell, key, target, sound)
+
+    def move(self, cell, key):
+        # (cell, sound) or None when the key doesn't move the cursor
+        return self.moves.get((cell, key))
+
+
 class Window:
     EDGE_WIDTH = 4
 
@@ -1560,35 +2300,134 @@ class Window:
         self.is_visible = False
 
 
+class GlyphAtlas:
+    # every glyph of one font and color, rendered once into a single surface
+
+    def __init__(self, font, color):
+        self.font = font
+        self.color = color
+        self.surface = pygame.Surface((256, font.get_height()), pygame.SRCALPHA, 32)
+        self.rects = {}  # { char: area of the glyph in the surface }
+        self.used_width = 0
+
+    def get(self, char):
+        rect = self.rects.get(char)
+        if rect is None:
+            glyph = self.font.render(char, True, self.color)
+            rect = Rect(self.used_width, 0, glyph.get_width(), glyph.get_height())
+            if rect.right > self.surface.get_width() or rect.bottom > self.surface.get_height():
+                self.grow(rect.right, rect.bottom)
+            #  BLEND_RGBA_MAX onto the transparent surface copies the pixels as they are
+            self.surface.blit(glyph, rect, special_flags=BLEND_RGBA_MAX)
+            self.rects[char] = rect
+            self.used_width = rect.right
+        return rect
+
+    def grow(self, width, height):
+        width = max(width, self.surface.get_width()*2)
+        height = max(height, self.surface.get_height())
+        surface = pygame.Surface((width, height), pygame.SRCALPHA, 32)
+        surface.blit(self.surface, (0, 0), special_flags=BLEND_RGBA_MAX)
+        self.surface = surface
+
+
 class MessageEngine:
 
+    fonts = {}  # { (font file path, size): font }, a font file is parsed only once per size
+    fonts_built = 0  # should stay flat once every size has been used
+
+    MAX_TEXT_SURFACES = 256
+    # { (message, font file path, size, color, antialias): rendered text }
+    # the least recently drawn text comes first
+    text_surfaces = OrderedDict()
+    text_hits = 0
+    text_misses = 0  # should stay flat once every text on the screen has been drawn
+    text_evictions = 0
+
     def __init__(self, directory, font_file, size, color):
         font_file_path = os.path.join(directory, font_file)
         self.font_file_path = font_file_path
-        self.font = pygame.font.Font(font_file_path, size)
+        self.size = size
+        self.font = self.get_font(size)
         self.color = color
         self.font_width = self.font.size(' ')[0]
         self.font_height = self.font.size(' ')[1]
         print(self.font_width, self.font_height)
+        self.glyph_atlases = {}  # { (size, color): GlyphAtlas }
+        self.styles = {}  # { name: (size, color) }
+        self.add_style("default", size, color)
+
+    def get_font(self, size):
+        key = (self.font_file_path, size)
+        font = self.fonts.get(key)
+        if font is None:
+            font = pygame.font.Font(self.font_file_path, size)
+            self.fonts[key] = font
+            MessageEngine.fonts_built += 1
+        return font
+
+    def add_style(self, name, size, color):
+        # build the font now so that switching to the style never opens the font file
+        self.get_font(size)
+        self.styles[name] = (size, color)
+
+    def set_style(self, name):
+        size, color = self.styles[name]
+        self.set_size(size)
+        self.set_color(color)
+
+    def render(self, message, antialias=True):
+        # most of the texts are the same every frame, so render them only once
+        key = (message, self.font_file_path, self.size, tuple(self.color), antialias)
+        text_surface = self.text_surfaces.get(key)
+        if text_surface is not None:
+            self.text_surfaces.move_to_end(key)
+            MessageEngine.text_hits += 1
+            return text_surface
+        MessageEngine.text_misses += 1
+        text_surface = self.font.render(message, antialias, self.color)
+        self.text_surfaces[key] = text_surface
+        if len(self.text_surfaces) > self.MAX_TEXT_SURFACES:
+            self.text_surfaces.popitem(last=False)
+            MessageEngine.text_evictions += 1
+        return text_surface
 
     def draw(self, screen, message, position):
-        text_rect = self.font.render(message, True, self.color)
+        text_rect = self.render(message)
         screen.blit(text_rect, position)
 
     def draw_center(self, screen, message, rect):
         # Author: Junhong
         # Date: 2016/11/12
         # Description: draw the string at the center of given rect
-        text_rect = self.font.render(message, True, self.color)
+        screen.blit(*self.render_center(message, rect))
+
+    def render_center(self, message, rect):
+        # return the rendered string and the position that puts it at the center of given rect
+        text_rect = self.render(message)
         text_width = text_rect.get_rect().width
         text_height = text_rect.get_rect().height
-        screen.blit(text_rect, (rect.centerx-text_width/2, rect.centery-text_height/2))
+        return text_rect, (rect.centerx-text_width/2, rect.centery-text_height/2)
+
+    def draw_glyphs(self, screen, glyphs):
+        # glyphs: [(char, position)]
+        # draw the characters one by one from the glyph atlas in a single blits call
+        key = (self.size, tuple(self.color))
+        atlas = self.glyph_atlases.get(key)
+        if atlas is None:
+            atlas = GlyphAtlas(self.font, self.color)
+            self.glyph_atlases[key] = atlas
+        # resolve every glyph first, the atlas surface is replaced when it grows
+        areas = [atlas.get(char) for char, position in glyphs]
+        surface = atlas.surface
+        screen.blits([(surface, position, area) for (char, position), area in zip(glyphs, areas)], doreturn=False)
 
     def set_color(self, color):
         self.color = color
 
     def set_size(self, size):
-        self.font = pygame.font.Font(self.font_file_path, size)
+        self.size = size
+        self.font = self.get_font(size)
         self.font_width = self.font.size(' ')[0]
         self.font_height = self.font.size(' ')[1]
 
@@ -1656,16 +2495,21 @@ class MessageWindow(Window):
 
     def draw(self, screen):
         #  maybe there's a better way to draw it
+        cursor_flag = (not self.hide_flag) and self.next_flag and int(self.frame / self.animation_cycle) % 2 == 0
+        mark_changed(self, (self.is_visible, id(self.text), self.current_page, self.current_position, cursor_flag),
+                     self.rect)
         Window.draw(self, screen)
         if not self.is_visible:
             return
+        glyphs = []
         for i in range(self.current_position):
             char = self.text[self.current_page*self.MAX_CHARS_PER_PAGE+i]
             if char == "/" or char == "%" or char == "$":
                 continue
             dx = self.text_rect[0] + self.message_engine.font_width*(i % self.MAX_CHARS_PER_LINE)
             dy = self.text_rect[1] + (self.LINE_HEIGHT+self.message_engine.font_height) * int(i / self.MAX_CHARS_PER_LINE)
-            self.message_engine.draw(screen, char, (dx, dy))
+            glyphs.append((char, (dx, dy)))
+        self.message_engine.draw_glyphs(screen, glyphs)
         if (not self.hide_flag) and self.next_flag:
             if int(self.frame / self.animation_cycle) % 2 == 0:
                 dx = self.text_rect[0] + (self.MAX_CHARS_PER_LINE / 2) * self.message_engine.font_width - self.message_engine.font_width / 2
@@ -1758,6 +2602,10 @@ class CommandWindow(Window):
     COMMAND = ["TALK", "STATUS", "EQUIPMENT", "DOOR",
                "SPELL", "ITEM", "TACTICS", "SEARCH"]
 
+    # two columns of commands, the cursor moves silently
+    NAVIGATION = NavigationGraph()
+    NAVIGATION.grid([[TALK, SPELL], [STATUS, ITEM], [EQUIPMENT, TACTICS], [DOOR, SEARCH]], sound=False)
+
     def __init__(self, rect, message_engine):
         Window.__init__(self, rect)
         self.text_rect = self.inner_rect.inflate(-32, -32)
@@ -1767,6 +2615,7 @@ class CommandWindow(Window):
         self.frame = 0
 
     def draw(self, screen):
+        mark_changed(self, (self.is_visible, self.command), self.rect)
         Window.draw(self, screen)
         if not self.is_visible:
             return
@@ -1848,6 +2697,8 @@ class Title:
         self.logo_image = load_image("data", "logo2.png")
         self.background_image = load_image("data", "sky.png")
         self.menu = self.START
+        self.message_enigne.add_style("title_menu", 20, BLACK)
+        self.message_enigne.add_style("title_credit", 16, BLACK)
         self.play_bgm()
 
     def input(self):
@@ -1862,15 +2713,15 @@ class Title:
         screen.blit(self.title_imgage, (0, -100))
         screen.blit(self.logo_image, (250, 430))
 
-        self.message_enigne.set_color(BLACK)
-        self.message_enigne.set_size(20)
+        self.message_enigne.set_style("title_menu")
         self.message_enigne.draw(screen, "START", (260, 300))
         self.message_enigne.draw(screen, "CONTINUE", (260, 340))
         self.message_enigne.draw(screen, "EXIT", (260, 380))
-        self.message_enigne.set_size(16)
+        self.message_enigne.set_style("title_credit")
         self.message_enigne.draw(screen, "2016 Laney Coding Club", (170, 410))
-        self.message_enigne.set_color(WHITE)
+        self.message_enigne.set_style("default")
 
+        mark_changed(self, self.menu, Rect(240, 300, self.cursor_image.get_width(), 80+self.cursor_image.get_height()))
         if self.menu == self.START:
             screen.blit(self.cursor_image, (240, 300))
         elif self.menu == self.CONTINUE:
@@ -1881,9 +2732,7 @@ class Title:
     def play_bgm(self):
         bgm_file_name = "title.ogg"
         bgm_file_path = os.path.join("bgm", bgm_file_name)
-        pygame.mixer.music.load(bgm_file_path)
-        pygame.mixer.music.set_volume(0.01)
-        pygame.mixer.music.play(-1)
+        music.play(bgm_file_path)
 
 
 class Battle:
@@ -1921,18 +2770,26 @@ class Battle:
         for battle_status_window in self.battle_status_windows:
             battle_status_window.hide()
 
-        self.enemy = map.enemies[random.randrange(len(map.enemies))].copy()
+        template, level = map.enemies[random.randrange(len(map.enemies))]
+        self.enemy = template.spawn(level)
         # self.enemy = copy.deepcopy(map.enemies[random.randrange(len(map.enemies))])
+        self.enemy_status_window = EnemyStatusWindow(self.enemy, self.message_engine)
 
         self.message_window.set_message("A wild " + self.enemy.name + "!")
         self.play_bgm()
 
 
+    def finish(self):
+        # the skill effects are cached as frames, so their sheets are not needed until the next battle
+        assets.unload("battle")
+
     def update(self):
         for battle_status_window in self.battle_status_windows:
             battle_status_window.update()
 
         self.enemy_status_window.update()
+        if self.skill_effect:
+            self.skill_effect.update()
 
 
     def draw(self, screen):
@@ -1940,10 +2797,13 @@ class Battle:
         center_rect = self.enemy.image.get_rect(center=SCREEN_RECT.center)
         screen.blit(self.enemy.image, center_rect)
         if self.skill_effect:
+            # the area of the effect has to be updated once more after the last frame
+            effect_rect = Rect(0, 0, SKILL_EFFECT_SIZE, SKILL_EFFECT_SIZE)
+            effect_rect.center = SCREEN_RECT.center
+            mark_changed(self, (self.skill_effect, self.skill_effect.life), effect_rect)
             if self.skill_effect.life:
                 self.skill_effect.draw(screen)
         self.command_window.draw(screen)
-        self.enemy_status_window = EnemyStatusWindow(self.enemy, self.message_engine)
         self.enemy_status_window.draw(screen)
         for battle_status_window in self.battle_status_windows:
             battle_status_window.draw(screen)
@@ -1952,8 +2812,7 @@ class Battle:
     def play_bgm(self):
         bgm_file_name = "battle.ogg"
         bgm_file_path = os.path.join("bgm", bgm_file_name)
-        pygame.mixer.music.load(bgm_file_path)
-        pygame.mixer.music.play(-1)
+        music.play(bgm_file_path, resume=False)  # every battle starts from the beginning
 
 
 
@@ -1973,6 +2832,7 @@ class BattleCommandWindow(Window):
         # self.selected_player = self.players[self.page]
 
     def draw(self, screen):
+        mark_changed(self, (self.is_visible, self.command), self.rect)
         Window.draw(self, screen)
         if not self.is_visible:
             return
@@ -2009,29 +2869,54 @@ class BattleStatusWindow(Window):
         # self.health_percentage = self.player.current_health / self.player.health
         # self.mana_percentage = self.player.current_mana / self.player.mana
         self.buffer = 4
+        # from the left of the circle to the right of the bars
+        self.rect = Rect(self.x - 32, self.y - 8, BAR_SIZE * 2 + self.buffer + 32, 48)
+        # the bars and the texts are rendered again only when the values change
+        self.bar_surface = pygame.Surface(self.rect.size).convert()
+        self.bar_surface.set_colorkey(COLOR_KEY)
+        self.texts = []  # [(text surface, position)]
+        self.rendered_status = None
 
     def draw(self, screen):
+        status = (self.player.current_health, self.player.health, self.player.current_mana, self.player.mana,
+                  tuple(self.message_engine.color))
+        if status != self.rendered_status:
+            self.render_status()
+            self.rendered_status = status
+
+        screen.blit(self.bar_surface, self.rect)
+        screen.blit(self.player.image, (self.x - 24, self.y))
+        screen.blits(self.texts, doreturn=False)
+        mark_changed(self, (self.player.image, status), self.rect)
+
+    def render_status(self):
         current_health = self.player.current_health if self.player.current_health >= 0 else 0
         current_mana = self.player.current_mana if self.player.current_mana >= 0 else 0
         health_percentage = current_health / self.player.health
         mana_percentage = current_mana / self.player.mana
 
-        pygame.draw.rect(screen, BLACK, Rect(self.x, self.y - self.buffer, BAR_SIZE * 2 + self.buffer, TILE_SIZE + (self.buffer * 5/2)))
+        # the bars are drawn relative to the cached surface
+        x = self.x - self.rect.x
+        y = self.y - self.rect.y
+        surface = self.bar_surface
+        surface.fill(COLOR_KEY)
+        pygame.draw.rect(surface, BLACK, Rect(x, y - self.buffer, BAR_SIZE * 2 + self.buffer, TILE_SIZE + (self.buffer * 5/2)))
         # pygame.draw.rect(screen, BLACK, Rect(self.x, self.y, TILE_SIZE * 2, TILE_SIZE))
-        pygame.draw.rect(screen, HP_RED, Rect(self.x, self.y, BAR_SIZE * 2 * health_percentage, TILE_SIZE / 2))
-        pygame.draw.rect(screen, MANA_BLUE, Rect(self.x, self.y + (TILE_SIZE / 2) + (self.buffer / 2), BAR_SIZE * 2 * mana_percentage, TILE_SIZE / 2))
-        pygame.draw.circle(screen, BLACK, [self.x - 8, self.y + 16], 24)
-        self.player.direction = DOWN
-        screen.blit(self.player.image, (self.x - 24, self.y))
-        self.player.update()
+        pygame.draw.rect(surface, HP_RED, Rect(x, y, BAR_SIZE * 2 * health_percentage, TILE_SIZE / 2))
+        pygame.draw.rect(surface, MANA_BLUE, Rect(x, y + (TILE_SIZE / 2) + (self.buffer / 2), BAR_SIZE * 2 * mana_percentage, TILE_SIZE / 2))
+        pygame.draw.circle(surface, BLACK, [x - 8, y + 16], 24)
+
         health_status_info = str(self.player.current_health) + "/" + str(self.player.health)
         mana_status_info = str(self.player.current_mana) + "/" + str(self.player.mana)
-        self.message_engine.draw_center(screen, health_status_info, Rect(self.x, self.y, BAR_SIZE * 2, TILE_SIZE / 2))
-        self.message_engine.draw_center(screen, mana_status_info, Rect(self.x, self.y + (TILE_SIZE / 2) + (self.buffer / 2), BAR_SIZE * 2, TILE_SIZE / 2))
+        self.texts = [
+            self.message_engine.render_center(health_status_info, Rect(self.x, self.y, BAR_SIZE * 2, TILE_SIZE / 2)),
+            self.message_engine.render_center(mana_status_info, Rect(self.x, self.y + (TILE_SIZE / 2) + (self.buffer / 2), BAR_SIZE * 2, TILE_SIZE / 2))]
 
     def update(self):
         # screen.blit(Character.images[self.player.name][1], (self.x - 24, self.y + 2))
-        pass
+        # the player walks facing the screen
+        self.player.direction = DOWN
+        self.player.update()
 
 
 class EnemyStatusWindow(Window):
@@ -2041,15 +2926,38 @@ class EnemyStatusWindow(Window):
     def __init__(self, enemy, message_engine):
         self.enemy = enemy
         self.message_engine = message_engine
+        self.rect = Rect(self.X - 5, self.Y - 32, 160, 64)
+        # the bar and the texts are rendered again only when the health changes
+        self.bar_surface = pygame.Surface(self.rect.size).convert()
+        self.bar_surface.set_colorkey(COLOR_KEY)
+        self.texts = []  # [(text surface, position)]
+        self.rendered_status = None
 
     def draw(self, screen):
+        status = (self.enemy.name, self.enemy.current_health, self.enemy.health, tuple(self.message_engine.color))
+        if status != self.rendered_status:
+            self.render_status()
+            self.rendered_status = status
+
+        screen.blit(self.bar_surface, self.rect)
+        screen.blits(self.texts, doreturn=False)
+        mark_changed(self, status, self.rect)
+
+    def render_status(self):
         current_health = self.enemy.current_health if self.enemy.current_health >= 0 else 0
         health_percentage = current_health / self.enemy.health
         health_status_info = str(current_health) + "/" + str(self.enemy.health)
-        pygame.draw.rect(screen, BLACK, Rect(self.X - 5, self.Y - 5, 160, (TILE_SIZE / 2) + 10))
-        pygame.draw.rect(screen, HP_RED, Rect(self.X, self.Y, BAR_SIZE * 3 * health_percentage, TILE_SIZE / 2))
-        self.message_engine.draw_center(screen, health_status_info, Rect(self.X, self.Y, BAR_SIZE * 3, TILE_SIZE / 2))
-        self.message_engine.draw_center(screen, self.enemy.name, Rect(self.X, self.Y - 16 - 5, BAR_SIZE * 3, TILE_SIZE / 2))
+
+        # the bar is drawn relative to the cached surface
+        x = self.X - self.rect.x
+        y = self.Y - self.rect.y
+        surface = self.bar_surface
+        surface.fill(COLOR_KEY)
+        pygame.draw.rect(surface, BLACK, Rect(x - 5, y - 5, 160, (TILE_SIZE / 2) + 10))
+        pygame.draw.rect(surface, HP_RED, Rect(x, y, BAR_SIZE * 3 * health_percentage, TILE_SIZE / 2))
+        self.texts = [
+            self.message_engine.render_center(health_status_info, Rect(self.X, self.Y, BAR_SIZE * 3, TILE_SIZE / 2)),
+            self.message_engine.render_center(self.enemy.name, Rect(self.X, self.Y - 16 - 5, BAR_SIZE * 3, TILE_SIZE / 2))]
 
     def update(self):
         pass
@@ -2174,10 +3082,11 @@ class Priest(Class):
                                  0, 4))
 
 
-class Enemy:
+class EnemyTemplate:
     # Author: Junhong Wang
     # Date: 2016/11/11
     # Description: parameters for enemy
+    # loaded once by load_enemy_batch and never changed, the sprite is shared by all the battles
 
     def __init__(self, id, name,
                  health, mana, attack, intelligence, defence, magic_resistance, agility, critical_hit, experience):
@@ -2185,7 +3094,6 @@ class Enemy:
         self.name = name
         self.image = load_image("enemybatch", name+".png")
         self.health = int(health)
-        self.current_health = int(health)
         self.mana = int(intelligence)
         self.attack = int(attack)
         self.intelligence = int(intelligence)
@@ -2194,24 +3102,36 @@ class Enemy:
         self.agility = int(agility)
         self.critical_hit = int(critical_hit)
         self.experience = int(experience)
-        self.level = 1
+
+    def spawn(self, level=1):
+        return Enemy(self, level)
+
+
+class Enemy:
+    # an enemy in a battle, made from the template without loading anything
+
+    def __init__(self, template, level=1):
+        self.template = template
+        self.id = template.id
+        self.name = template.name
+        self.image = template.image
+        self.mana = template.mana
+        self.set_level(level)
 
     def copy(self):
-        return Enemy(self.id, self.name, self.health, self.mana, self.attack, self.intelligence, self.defence,
-                      self.magic_resistance,
-                      self.agility, self.critical_hit, self.experience)
+        return Enemy(self.template, self.level)
 
     def set_level(self, level):
         self.level = level
-        self.health *= level
+        self.health = self.template.health * level
         self.current_health = int(self.health)
-        self.attack *= level
-        self.intelligence *= level
-        self.defence *= level
-        self.magic_resistance *= level
-        self.agility *= level
-        self.critical_hit *= level
-        self.experience *= level
+        self.attack = self.template.attack * level
+        self.intelligence = self.template.intelligence * level
+        self.defence = self.template.defence * level
+        self.magic_resistance = self.template.magic_resistance * level
+        self.agility = self.template.agility * level
+        self.critical_hit = self.template.critical_hit * level
+        self.experience = self.template.experience * level
 
 
 class PlayerStatusWindow(Window):
@@ -2235,6 +3155,10 @@ class PlayerStatusWindow(Window):
 
     STATUS_WINDOW, SKILLS_WINDOW = 0, 1
 
+    # the cursor moves between the windows while no points are being distributed
+    NAVIGATION = NavigationGraph()
+    NAVIGATION.grid([[STATUS_WINDOW, SKILLS_WINDOW]])
+
     MAX_ALPHA = 200
     MIN_ALPHA = 100
 
@@ -2279,8 +3203,16 @@ class PlayerStatusWindow(Window):
 
         self.points_distribution_flag = False
 
+        self.layers = {}  # { page: (player status, background layer, label layer) }
+        # the transparent rects are filled with a new alpha every frame
+        self.status_points_surface = pygame.Surface(self.status_points_rect.size, pygame.SRCALPHA)
+        self.skill_points_surface = pygame.Surface(self.skill_points_rect.size, pygame.SRCALPHA)
+        self.level_surface = pygame.Surface(self.level_rect.size, pygame.SRCALPHA)
+        self.experience_surface = pygame.Surface(self.experience_rect.size, pygame.SRCALPHA)
+
     def update(self):
         self.frame += 1
+        self.selected_player.update()
 
         if self.alpha > self.MAX_ALPHA:
             self.alpha_flag = False
@@ -2298,91 +3230,46 @@ class PlayerStatusWindow(Window):
 
         # prepare
         self.message_engine.set_color(BLACK)
+        background_layer, label_layer = self.get_layers()
 
-        if not self.points_distribution_flag:
-            selected_player = self.party.members[self.page]
-            self.selected_player = selected_player
-            hp = selected_player.health
-            atk = selected_player.attack
-            int = selected_player.intelligence
-            de = selected_player.defence
-            mgr = selected_player.magic_resistance
-            agi = selected_player.agility
-            cri = selected_player.critical_hit
-            exe = selected_player.experience
-            self.status_before = [selected_player.health, selected_player.attack, selected_player.intelligence,
-                    selected_player.defence, selected_player.magic_resistance, selected_player.agility,
-                    selected_player.critical_hit, selected_player.experience]
-            self.status_after = [hp, atk, int, de, mgr, agi, cri, exe]
+        mark_changed(self, (self.page, self.selection, self.points_distribution_flag, self.status_cursor_position,
+                            tuple(self.status_after), self.selected_player.status_points), self.rect)
+        # the transparent rects blink and the player walks every frame
+        mark_dirty(self.status_points_rect, self.skill_points_rect, self.level_rect, self.experience_rect,
+                   Rect(0.45*self.rect.width+0.5*TILE_SIZE, 0.15*self.rect.height+0.5*TILE_SIZE, TILE_SIZE, TILE_SIZE))
 
-        self.selected_player.update()
-
-        # background
-        screen.blit(self.background_image, (0, 0))
-
-        # top_rect
-        offset_y = 8
-        if not self.page == 0:
-            screen.blit(self.cursor_left_image, (0.05*self.rect.width, offset_y))
-        if not self.page == len(self.party.members) - 1:
-            screen.blit(self.cursor_right_image, (0.95*self.rect.width-self.cursor_right_image.get_width(), offset_y))
-
-        class_name = str(type(self.selected_player))[17:-2]
-        self.message_engine.draw_center(screen, self.selected_player.name + " ( " + class_name + " )", self.top_rect)
+        # background, top_rect and text_rect
+        screen.blit(background_layer, (0, 0))
 
         # status_window / skills_window
-        trans_white_color = (WHITE[0], WHITE[1], WHITE[2], self.alpha)
-        trans_orange_color = (ORANGE[0], ORANGE[1], ORANGE[2], self.alpha)
         if self.selection == self.STATUS_WINDOW:
-            surface = pygame.Surface(self.status_points_rect.size, pygame.SRCALPHA)
-            if self.points_distribution_flag:
-                surface.fill((WHITE[0], WHITE[1], WHITE[2], self.MAX_ALPHA))
-
-                # status_cursor
-                dx = self.status_points_rect.left
-                dy = self.status_points_rect.top + self.rect.height * 0.03 + (self.message_engine.font_height+self.LINE_HEIGHT) * (self.status_cursor_position+1)
-                screen.blit(self.status_cursor_image, (dx, dy))
-
-            else:
-                surface.fill(trans_white_color)
-            screen.blit(surface, self.status_points_rect.topleft)
-
-            surface = pygame.Surface(self.skill_points_rect.size, pygame.SRCALPHA)
-            surface.fill((WHITE[0], WHITE[1], WHITE[2], self.MIN_ALPHA))
-            screen.blit(surface, self.skill_points_rect.topleft)
+            selected_rect, selected_surface = self.status_points_rect, self.status_points_surface
+            other_surface = self.skill_points_surface
+        else:
+            selected_rect, selected_surface = self.skill_points_rect, self.skill_points_surface
+            other_surface = self.status_points_surface
+        if self.points_distribution_flag:
+            selected_surface.fill((WHITE[0], WHITE[1], WHITE[2], self.MAX_ALPHA))
 
-        elif self.selection == self.SKILLS_WINDOW:
-            surface = pygame.Surface(self.skill_points_rect.size, pygame.SRCALPHA)
-            if self.points_distribution_flag:
-                surface.fill((WHITE[0], WHITE[1], WHITE[2], self.MAX_ALPHA))
+            # status_cursor
+            dx = selected_rect.left
+            dy = selected_rect.top + self.rect.height * 0.03 + (self.message_engine.font_height+self.LINE_HEIGHT) * (self.status_cursor_position+1)
+            screen.blit(self.status_cursor_image, (dx, dy))
+        else:
+            selected_surface.fill((WHITE[0], WHITE[1], WHITE[2], self.alpha))
+        other_surface.fill((WHITE[0], WHITE[1], WHITE[2], self.MIN_ALPHA))
 
-                # status_cursor
-                dx = self.skill_points_rect.left
-                dy = self.skill_points_rect.top + self.rect.height * 0.03 + (
-                                                                             self.message_engine.font_height + self.LINE_HEIGHT) * (
-                                                                             self.status_cursor_position + 1)
-                screen.blit(self.status_cursor_image, (dx, dy))
+        # level_rect and experience_rect
+        self.level_surface.fill((ORANGE[0], ORANGE[1], ORANGE[2], self.alpha))
+        self.experience_surface.fill((ORANGE[0], ORANGE[1], ORANGE[2], self.alpha))
 
-            else:
-                surface.fill(trans_white_color)
-            screen.blit(surface, self.skill_points_rect.topleft)
-
-            surface = pygame.Surface(self.status_points_rect.size, pygame.SRCALPHA)
-            surface.fill((WHITE[0], WHITE[1], WHITE[2], self.MIN_ALPHA))
-            screen.blit(surface, self.status_points_rect.topleft)
-
-        # level_rect
-        surface = pygame.Surface(self.level_rect.size, pygame.SRCALPHA)
-        surface.fill(trans_orange_color)
-        screen.blit(surface, self.level_rect.topleft)
-        # experience_rect
-        surface = pygame.Surface(self.experience_rect.size, pygame.SRCALPHA)
-        surface.fill(trans_orange_color)
-        screen.blit(surface, self.experience_rect.topleft)
+        screen.blits([(self.status_points_surface, self.status_points_rect.topleft),
+                      (self.skill_points_surface, self.skill_points_rect.topleft),
+                      (self.level_surface, self.level_rect.topleft),
+                      (self.experience_surface, self.experience_rect.topleft)], doreturn=False)
 
-        # text_rect
-        pygame.draw.rect(screen, WHITE, self.text_rect, 0)
-        pygame.draw.rect(screen, BLACK, self.text_inner_rect, 0)
+        # icons and labels
+        screen.blit(label_layer, (0, 0))
 
         # text on status_window
         dx = self.status_points_rect.left
@@ -2393,60 +3280,26 @@ class PlayerStatusWindow(Window):
         offset_x = self.status_points_rect.width * 0.5
         cursor_offset = offset_x * 0.5
         for i in range(0, len(self.STATUS)):
-            dx = self.status_points_rect.left
+            dx = self.status_points_rect.left + self.status_images[i].get_rect().width
             dy = self.status_points_rect.top + offset_y + (self.message_engine.font_height+self.LINE_HEIGHT) * (i+1)
-            screen.blit(self.status_images[i], (dx, dy))
-            self.message_engine.draw(screen, self.STATUS[i], (dx+self.status_images[i].get_rect().width, dy))
             if self.points_distribution_flag and self.selected_player.status_points:
                 if i == self.status_cursor_position:
-                    screen.blit(self.cursor_right_image, (dx+self.status_images[i].get_rect().width+offset_x+cursor_offset, dy))
+                    screen.blit(self.cursor_right_image, (dx+offset_x+cursor_offset, dy))
             if self.status_after[i] != self.status_before[i]:
                 if i == self.status_cursor_position:
-                    screen.blit(self.cursor_left_image,
-                                (dx + self.status_images[i].get_rect().width + offset_x - cursor_offset, dy))
+                    screen.blit(self.cursor_left_image, (dx+offset_x-cursor_offset, dy))
                 self.message_engine.set_color(RED)
-                self.message_engine.draw(screen, str(self.status_after[i]),
-                                         (dx+self.status_images[i].get_rect().width+offset_x, dy))
+                self.message_engine.draw(screen, str(self.status_after[i]), (dx+offset_x, dy))
                 self.message_engine.set_color(BLACK)
             else:
-                self.message_engine.draw(screen, str(self.status_after[i]),
-                                         (dx + self.status_images[i].get_rect().width + offset_x, dy))
+                self.message_engine.draw(screen, str(self.status_after[i]), (dx+offset_x, dy))
 
         screen.blit(self.selected_player.image, (0.45*self.rect.width+0.5*TILE_SIZE, 0.15*self.rect.height+0.5*TILE_SIZE))
 
-        # text on level_rect
-        dx = self.level_rect.left
-        dy = self.level_rect.top
-        self.message_engine.draw(screen, "LEVEL", (dx, dy))
-        dx = self.level_rect.centerx - self.message_engine.font_width*0.5
-        dy = self.level_rect.centery
-        self.message_engine.draw(screen, str(self.selected_player.level), (dx, dy))
-
-        # text on experience_rect
-        dx = self.experience_rect.left
-        dy = self.experience_rect.top
-        self.message_engine.draw(screen, "EXP", (dx+self.message_engine.font_width, dy))
-        self.message_engine.draw(screen, "NEXT",
-                                 (dx+0.5*self.message_engine.font_width, dy+self.message_engine.font_height))
-        dx = self.experience_rect.centerx
-        self.message_engine.draw(screen, str(self.selected_player.experience),
-                                 (dx-self.message_engine.font_width*0.5, dy+self.message_engine.font_height*2))
-
         # text on skills_window
         dx = self.skill_points_rect.left
         dy = self.skill_points_rect.top
-        offset_y = self.rect.height * 0.03
-        offset_x = self.rect.width * 0.25
         self.message_engine.draw(screen, " SKILLS"+"       "+str(self.selected_player.skill_points)+"pt", (dx, dy))
-        for i in range(0, 4):
-            name = self.selected_player.skills[i].name
-            name_list = name.split()
-            name_shortened = ""
-            for word in name_list:
-                name_shortened += word[:1]
-            self.message_engine.draw(screen, " "+name_shortened,
-                                     (dx, dy+offset_y+(self.message_engine.font_height+self.LINE_HEIGHT)*(i+1)))
-            self.message_engine.draw(screen, str(self.selected_player.skills[i].level), (dx+offset_x, dy+offset_y+(self.message_engine.font_height+self.LINE_HEIGHT)*(i+1)))
 
         # text on text_rect
         dx = self.text_inner_rect.left
@@ -2466,16 +3319,111 @@ class PlayerStatusWindow(Window):
         # finish drawing
         # self.message_engine.set_color(WHITE)
 
+    def show(self):
+        self.select_page(self.page)
+        self.is_visible = True
+
+    def select_page(self, page):
+        # status_after keeps the points distributed to the selected player until they are applied
+        self.page = page
+        self.selected_player = self.party.members[self.page]
+        self.status_before = [self.selected_player.health, self.selected_player.attack,
+                              self.selected_player.intelligence, self.selected_player.defence,
+                              self.selected_player.magic_resistance, self.selected_player.agility,
+                              self.selected_player.critical_hit, self.selected_player.experience]
+        self.status_after = list(self.status_before)
+
+    def get_layers(self):
+        # the parts of the page which only change with the page or the player status
+        # are drawn once into the layers of the page
+        player = self.selected_player
+        key = (player.level, player.experience, tuple((skill.name, skill.level) for skill in player.skills))
+        layers = self.layers.get(self.page)
+        if layers is None or layers[0] != key:
+            layers = (key, self.draw_background_layer(), self.draw_label_layer())
+            self.layers[self.page] = layers
+        return layers[1], layers[2]
+
+    def draw_background_layer(self):
+        layer = pygame.Surface(self.rect.size).convert()
+
+        # background
+        layer.blit(self.background_image, (0, 0))
+
+        # top_rect
+        offset_y = 8
+        if not self.page == 0:
+            layer.blit(self.cursor_left_image, (0.05*self.rect.width, offset_y))
+        if not self.page == len(self.party.members) - 1:
+            layer.blit(self.cursor_right_image, (0.95*self.rect.width-self.cursor_right_image.get_width(), offset_y))
+
+        class_name = str(type(self.selected_player))[17:-2]
+        self.message_engine.draw_center(layer, self.selected_player.name + " ( " + class_name + " )", self.top_rect)
+
+        # text_rect
+        pygame.draw.rect(layer, WHITE, self.text_rect, 0)
+        pygame.draw.rect(layer, BLACK, self.text_inner_rect, 0)
+        return layer
+
+    def draw_label_layer(self):
+        # transparent, so that it can be put over the blinking rects
+        layer = pygame.Surface(self.rect.size, pygame.SRCALPHA, 32)
+
+        # icons and names of the status
+        offset_y = self.rect.height * 0.03
+        for i in range(0, len(self.STATUS)):
+            dx = self.status_points_rect.left
+            dy = self.status_points_rect.top + offset_y + (self.message_engine.font_height+self.LINE_HEIGHT) * (i+1)
+            layer.blit(self.status_images[i], (dx, dy))
+            self.message_engine.draw(layer, self.STATUS[i], (dx+self.status_images[i].get_rect().width, dy))
+
+        # text on level_rect
+        dx = self.level_rect.left
+        dy = self.level_rect.top
+        self.message_engine.draw(layer, "LEVEL", (dx, dy))
+        dx = self.level_rect.centerx - self.message_engine.font_width*0.5
+        dy = self.level_rect.centery
+        self.message_engine.draw(layer, str(self.selected_player.level), (dx, dy))
+
+        # text on experience_rect
+        dx = self.experience_rect.left
+        dy = self.experience_rect.top
+        self.message_engine.draw(layer, "EXP", (dx+self.message_engine.font_width, dy))
+        self.message_engine.draw(layer, "NEXT",
+                                 (dx+0.5*self.message_engine.font_width, dy+self.message_engine.font_height))
+        dx = self.experience_rect.centerx
+        self.message_engine.draw(layer, str(self.selected_player.experience),
+                                 (dx-self.message_engine.font_width*0.5, dy+self.message_engine.font_height*2))
+
+        # names and levels of the skills
+        dx = self.skill_points_rect.left
+        dy = self.skill_points_rect.top
+        offset_y = self.rect.height * 0.03
+        offset_x = self.rect.width * 0.25
+        for i, skill in enumerate(self.selected_player.skills[:4]):
+            name_list = skill.name.split()
+            name_shortened = ""
+            for word in name_list:
+                name_shortened += word[:1]
+            self.message_engine.draw(layer, " "+name_shortened,
+                                     (dx, dy+offset_y+(self.message_engine.font_height+self.LINE_HEIGHT)*(i+1)))
+            self.message_engine.draw(layer, str(skill.level), (dx+offset_x, dy+offset_y+(self.message_engine.font_height+self.LINE_HEIGHT)*(i+1)))
+        return layer
+
     def play_bgm(self):
         bgm_file_name = "shop.ogg"
         bgm_file_path = os.path.join("bgm", bgm_file_name)
-        pygame.mixer.music.load(bgm_file_path)
-        pygame.mixer.music.play(-1)
+        music.play(bgm_file_path)
 
 
 class Skill:
 
     MAX_LIFE = 10
+    MAX_FRAME_BANKS = 8  # how many effect sheets stay in memory
+
+    # { image_name: [frame to draw for each life] }, shared by the skills using the same sheet
+    # the least recently used sheet comes first
+    frame_banks = OrderedDict()
 
     def __init__(self, name, image_name, description, bonus_power, bonus_rate):
         self.name = name
@@ -2487,36 +3435,58 @@ class Skill:
         self.bonus_rate = bonus_rate
 
         self.level = 0
-        self.images = split_image(load_image("skilleffect", image_name+".png"), SKILL_EFFECT_SIZE)
+        # loaded when the skill is invoked for the first time
+        self.frames = None
 
         self.life = 0
 
         self.die_flag = False
 
+    def update(self):
+        # one frame of the effect per step
+        if self.life:
+            self.life -= 1
+            if self.life == 0:
+                self.die_flag = True
+
     def draw(self, screen):
-        index = (len(self.images) - 1) - int(self.life / (self.MAX_LIFE / len(self.images)))
-        if index < 0:
-            index = 0
-        # print(index)
-        center_rect = self.images[index].get_rect(center=SCREEN_RECT.center)
-        blend_factor = self.life % (self.MAX_LIFE / len(self.images))
-        # print(blend_factor)
-        if index + 1 < len(self.images):
-            image = blend_image(self.images[index], self.images[index+1], blend_factor)
-        else:
-            image = self.images[index]
+        image = self.frames[self.life]
+        center_rect = image.get_rect(center=SCREEN_RECT.center)
         screen.blit(image, center_rect)
-        self.life -= 1
-
-        if self.life == 0:
-            self.die_flag = True
 
     def invoke(self):
+        self.frames = self.load_frames()
         self.life = self.MAX_LIFE
         sounds["sword_slice"].play()
 
     def reset(self):
         self.die_flag = False
+        # let frame_banks decide how long the frames stay in memory
+        self.frames = None
+
+    def load_frames(self):
+        # blend the animation once and play it back with plain blits
+        frames = self.frame_banks.get(self.image_name)
+        if frames:
+            self.frame_banks.move_to_end(self.image_name)
+            return frames
+        images = split_image(load_image("skilleffect", self.image_name+".png", "battle"), SKILL_EFFECT_SIZE)
+        frames = [None]  # nothing is drawn when life is 0
+        for life in range(1, self.MAX_LIFE+1):
+            frames.append(self.interpolate(images, life))
+        self.frame_banks[self.image_name] = frames
+        if len(self.frame_banks) > self.MAX_FRAME_BANKS:
+            self.frame_banks.popitem(last=False)
+        return frames
+
+    def interpolate(self, images, life):
+        index = (len(images) - 1) - int(life / (self.MAX_LIFE / len(images)))
+        if index < 0:
+            index = 0
+        blend_factor = life % (self.MAX_LIFE / len(images))
+        if index + 1 < len(images):
+            return blend_image(images[index], images[index+1], blend_factor)
+        return images[index]
 
 
 class Shop:
@@ -2530,7 +3500,7 @@ class Shop:
 
     def load(self):
         file_path = os.path.join("data", self.name+".shop")
-        file = open(file_path)
+        file = assets.open_file(file_path)
         for line in file:
             line = line.rstrip()
             if line.startswith("#"):
@@ -2588,11 +3558,58 @@ class ShopWindow(Window):
         self.price_rect = Rect(0, 0, 100, self.message_engine.font_height+8)
         self.price_inner_rect = self.price_rect.inflate(-8, -8)
 
+        # boards and boxes, drawn once
+        self.background_layer = None
+        # background with the items in the inventory and the shop,
+        # drawn again only after invalidate_item_layer is called
+        self.item_layer = None
+
     def set_clerk(self, clerk):
         self.clerk = clerk
         self.items_on_sale = self.clerk.shop.items_on_sale
+        Item.prefetch(self.items_on_sale + Player.inventory)
+        self.invalidate_item_layer()
         self.show()
 
+    def invalidate_item_layer(self):
+        # should be called whenever the inventory changes
+        self.item_layer = None
+
+    def get_item_layer(self):
+        if self.background_layer is None:
+            self.background_layer = pygame.Surface(self.rect.size).convert()
+            # draw boards
+            self.background_layer.blit(self.shop_background_image, (0, 0))
+            self.background_layer.blit(self.inventory_image, self.inventory_rect.topleft)
+            self.background_layer.blit(self.shop_shelf_image, self.shop_shelf_rect.topleft)
+            # draw the text boxes
+            pygame.draw.rect(self.background_layer, WHITE, self.text_rect, 0)
+            pygame.draw.rect(self.background_layer, BLACK, self.text_inner_rect, 0)
+            # draw gold box
+            pygame.draw.rect(self.background_layer, WHITE, self.gold_rect, 0)
+            pygame.draw.rect(self.background_layer, BLACK, self.gold_inner_rect, 0)
+
+        if self.item_layer is None:
+            self.item_layer = self.background_layer.copy()
+            # draw items (inventory)
+            offset = 15
+            for i in range(len(Player.inventory)):
+                if Player.inventory[i]:
+                    dx = self.inventory_rect.left + 50*(i % 5)
+                    dy = self.inventory_rect.top + 50*int(i / 5)
+                    self.item_layer.blit(Player.inventory[i].image, (dx+offset, dy+offset))
+            # draw items (shop)
+            dx = self.shop_shelf_rect.left
+            dy = self.shop_shelf_rect.top
+            offset1_x = 25
+            offset1_y = 25
+            offset2_x = 50
+            offset2_y = 50
+            for i in range(len(self.items_on_sale)):
+                self.item_layer.blit(self.items_on_sale[i].image,
+                                     (dx+offset1_x+offset2_x*(i % 3), dy+offset1_y+offset2_y*int(i / 3)))
+        return self.item_layer
+
     def update(self):
         if self.cursor_in_shop_shelf:
             if self.cursor_position == 10:
@@ -2600,28 +3617,22 @@ class ShopWindow(Window):
             elif self.cursor_position == 11:
                 self.cursor_position = 8
 
-    def draw(self, screen):
-        # draw boards
-        screen.blit(self.shop_background_image, (0, 0))
-        screen.blit(self.inventory_image, self.inventory_rect.topleft)
-        screen.blit(self.shop_shelf_image, self.shop_shelf_rect.topleft)
+        # the gold counts down to the price of the purchase
+        if self.purchase_price == 0:
+            pass
+        elif self.purchase_price - self.gold_decrease_speed >= 0:
+            self.purchase_price -= self.gold_decrease_speed
+            Player.gold -= self.gold_decrease_speed
+        else:
+            # self.purchase_price - self.gold_decrease_speed < 0
+            Player.gold -= self.purchase_price
+            self.purchase_price = 0
 
-        # draw items (inventory)
-        offset = 15
-        for i in range(len(Player.inventory)):
-            if Player.inventory[i]:
-                dx = self.inventory_rect.left + 50*(i % 5)
-                dy = self.inventory_rect.top + 50*int(i / 5)
-                screen.blit(Player.inventory[i].image, (dx+offset, dy+offset))
-        # draw items (shop)
-        dx = self.shop_shelf_rect.left
-        dy = self.shop_shelf_rect.top
-        offset1_x = 25
-        offset1_y = 25
-        offset2_x = 50
-        offset2_y = 50
-        for i in range(len(self.items_on_sale)):
-            screen.blit(self.items_on_sale[i].image, (dx+offset1_x+offset2_x*(i % 3), dy+offset1_y+offset2_y*int(i / 3)))
+    def draw(self, screen):
+        mark_changed(self, (self.cursor_position, self.cursor_in_shop_shelf, self.is_grabbing, self.selected_item,
+                            tuple(Player.inventory), Player.gold, self.purchase_price), self.rect)
+        # draw boards, boxes and items
+        screen.blit(self.get_item_layer(), (0, 0))
 
         # draw the hand cursor
         offset1 = 50
@@ -2682,10 +3693,6 @@ class ShopWindow(Window):
                     self.message_engine.draw(screen, "G", (dx, dy))
 
 
-        # draw the text boxes
-        pygame.draw.rect(screen, WHITE, self.text_rect, 0)
-        pygame.draw.rect(screen, BLACK, self.text_inner_rect, 0)
-
         # draw the texts
         if self.cursor_in_shop_shelf:
             if self.cursor_position < len(self.items_on_sale):
@@ -2708,24 +3715,9 @@ class ShopWindow(Window):
             except IndexError:
                 pass
 
-        # draw gold box
-        pygame.draw.rect(screen, WHITE, self.gold_rect, 0)
-        pygame.draw.rect(screen, BLACK, self.gold_inner_rect, 0)
-
         # draw the amount of gold
         dx = self.gold_inner_rect.left
         dy = self.gold_inner_rect.top
-
-        if self.purchase_price == 0:
-            pass
-        elif self.purchase_price - self.gold_decrease_speed >= 0:
-            self.purchase_price -= self.gold_decrease_speed
-            Player.gold -= self.gold_decrease_speed
-        else:
-            # self.purchase_price - self.gold_decrease_speed < 0
-            Player.gold -= self.purchase_price
-            self.purchase_price = 0
-
         self.message_engine.draw(screen, str(Player.gold), (dx, dy))
 
         dx = self.gold_inner_rect.right - self.message_engine.font_width
@@ -2734,8 +3726,7 @@ class ShopWindow(Window):
     def play_bgm(self):
         bgm_file_name = "shop.ogg"
         bgm_file_path = os.path.join("bgm", bgm_file_name)
-        pygame.mixer.music.load(bgm_file_path)
-        pygame.mixer.music.play(-1)
+        music.play(bgm_file_path)
 
 
 class ItemWindow(Window):
@@ -2746,6 +3737,35 @@ class ItemWindow(Window):
 
     STATUS = ["HP", "ATK", "INT", "DEF", "MGR", "AGL", "CRI", "EXE"]
     INVENTORY_RECT, EQUIPMENT_RECT, BAG_RECT, DROP_RECT = 0, 1, 2, 3
+    # equipment of the selected player under each cell of the equipment rect
+    EQUIPMENT_SLOTS = ["weapon", "head", "accessory", "body", "boots", "arms"]
+
+    # the cells of the rects and the jumps between them
+    NAVIGATION = NavigationGraph()
+    NAVIGATION.grid([range(i, i + 5) for i in range(0, 25, 5)], INVENTORY_RECT)
+    NAVIGATION.grid([range(5)], BAG_RECT)
+    NAVIGATION.grid([[0, 1], [2, 3], [4, 5]], EQUIPMENT_RECT)
+    NAVIGATION.link((INVENTORY_RECT, 0), K_LEFT, (BAG_RECT, 4))
+    NAVIGATION.link((INVENTORY_RECT, 5), K_LEFT, (EQUIPMENT_RECT, 1))
+    NAVIGATION.link((INVENTORY_RECT, 10), K_LEFT, (EQUIPMENT_RECT, 3))
+    NAVIGATION.link((INVENTORY_RECT, 15), K_LEFT, (EQUIPMENT_RECT, 3))
+    NAVIGATION.link((INVENTORY_RECT, 20), K_LEFT, (EQUIPMENT_RECT, 5))
+    NAVIGATION.link((INVENTORY_RECT, 4), K_RIGHT, (DROP_RECT, 0), sound=False)
+    NAVIGATION.link((INVENTORY_RECT, 9), K_RIGHT, (DROP_RECT, 0), sound=False)
+    NAVIGATION.link((INVENTORY_RECT, 14), K_RIGHT, (DROP_RECT, 0), sound=False)
+    NAVIGATION.link((INVENTORY_RECT, 19), K_RIGHT, (DROP_RECT, 0), sound=False)
+    NAVIGATION.link((INVENTORY_RECT, 24), K_RIGHT, (DROP_RECT, 0), sound=False)
+    NAVIGATION.link((DROP_RECT, 0), K_LEFT, (INVENTORY_RECT, 24))
+    NAVIGATION.link((BAG_RECT, 4), K_RIGHT, (INVENTORY_RECT, 0))
+    NAVIGATION.link((BAG_RECT, 0), K_DOWN, (EQUIPMENT_RECT, 0))
+    NAVIGATION.link((BAG_RECT, 1), K_DOWN, (EQUIPMENT_RECT, 0))
+    NAVIGATION.link((BAG_RECT, 3), K_DOWN, (EQUIPMENT_RECT, 1))
+    NAVIGATION.link((BAG_RECT, 4), K_DOWN, (EQUIPMENT_RECT, 1))
+    NAVIGATION.link((EQUIPMENT_RECT, 0), K_UP, (BAG_RECT, 0))
+    NAVIGATION.link((EQUIPMENT_RECT, 1), K_UP, (BAG_RECT, 4))
+    NAVIGATION.link((EQUIPMENT_RECT, 1), K_RIGHT, (INVENTORY_RECT, 5))
+    NAVIGATION.link((EQUIPMENT_RECT, 3), K_RIGHT, (INVENTORY_RECT, 10))
+    NAVIGATION.link((EQUIPMENT_RECT, 5), K_RIGHT, (INVENTORY_RECT, 20))
 
     def __init__(self, rect, message_engine, party):
         Window.__init__(self, rect)
@@ -2795,87 +3815,140 @@ class ItemWindow(Window):
         self.page = 0
         self.selected_player = self.party.members[self.page]
 
+        # boards and labels, drawn once
+        self.background_layer = None
+        # background with the items and the status of the selected player,
+        # drawn again only after invalidate_item_layer is called
+        self.item_layer = None
 
-    def update(self):
-        self.party.members[0].update()
+    def show(self):
+        # the status may have changed while the window was closed
+        Item.prefetch(Player.inventory)
+        for player in self.party.members:
+            Item.prefetch(player.bag + [player.weapon, player.head, player.accessory, player.body, player.boots, player.arms])
+        self.invalidate_item_layer()
+        self.is_visible = True
 
-    def draw(self, screen):
-        screen.blit(self.background_image, (0, 0))
+    def invalidate_item_layer(self):
+        # should be called whenever the inventory, the bag or the equipments change
+        self.item_layer = None
+
+    def get_slot(self):
+        # item under the cursor
+        if self.cursor_is_in == self.INVENTORY_RECT:
+            return Player.inventory[self.cursor_position]
+        elif self.cursor_is_in == self.BAG_RECT:
+            return self.selected_player.bag[self.cursor_position]
+        elif self.cursor_is_in == self.EQUIPMENT_RECT:
+            return getattr(self.selected_player, self.EQUIPMENT_SLOTS[self.cursor_position])
+
+    def set_slot(self, item):
+        # put the item under the cursor
+        if self.cursor_is_in == self.INVENTORY_RECT:
+            Player.inventory[self.cursor_position] = item
+        elif self.cursor_is_in == self.BAG_RECT:
+            self.selected_player.bag[self.cursor_position] = item
+        elif self.cursor_is_in == self.EQUIPMENT_RECT:
+            setattr(self.selected_player, self.EQUIPMENT_SLOTS[self.cursor_position], item)
+
+    def get_item_layer(self):
+        if self.background_layer is None:
+            self.background_layer = self.draw_background_layer()
+        if self.item_layer is None:
+            self.item_layer = self.background_layer.copy()
+            self.draw_items(self.item_layer)
+        return self.item_layer
+
+    def draw_background_layer(self):
+        layer = pygame.Surface(self.rect.size).convert()
+        layer.blit(self.background_image, (0, 0))
 
         # draw selected player info
         dx = self.player_info_rect.left
         dy = self.player_info_rect.top
         offset_y = 10
-        screen.blit(self.cursor_left_image, (dx, dy + offset_y))
+        layer.blit(self.cursor_left_image, (dx, dy + offset_y))
         dx = self.player_info_rect.right
-        screen.blit(self.cursor_right_image, (dx - self.cursor_right_image.get_rect().width, dy + offset_y))
-        self.message_engine.draw_center(screen, self.selected_player.name, self.player_info_rect)
+        layer.blit(self.cursor_right_image, (dx - self.cursor_right_image.get_rect().width, dy + offset_y))
+        self.message_engine.draw_center(layer, self.selected_player.name, self.player_info_rect)
 
         # bag rect
         dx = self.bag_rect.centerx
         dy = self.bag_rect.top
         offset_x = self.bag_image.get_rect().width*0.5
-        screen.blit(self.bag_image, (dx - offset_x, dy))
-
-        # draw items in bag
-        for i in range(5):
-            item = self.selected_player.bag[i]
-            if item:
-                offset2_x = 25 - item.image.get_rect().width*0.5
-                offset3_x = 50 * i
-                offset2_y = self.bag_image.get_rect().height * 0.5 - item.image.get_rect().height * 0.5
-                screen.blit(item.image, (dx - offset_x + offset2_x + offset3_x, dy + offset2_y))
-
+        layer.blit(self.bag_image, (dx - offset_x, dy))
 
         # inventory rect
         dx = self.inventory_rect.left
         dy = self.inventory_rect.top
         offset_x = 10
         offset_y = 20
-        screen.blit(self.inventory_image, (dx + offset_x, dy + offset_y))
+        layer.blit(self.inventory_image, (dx + offset_x, dy + offset_y))
         offset_x = self.inventory_image.get_rect().width + 20
         offset_y = self.inventory_image.get_rect().height - 30
-        screen.blit(self.drop_image, (dx + offset_x, dy + offset_y))
-
-        # draw items in the inventory
-        for i in range(len(Player.inventory)):
-            if Player.inventory[i]:
-                dx = self.inventory_rect.left
-                dy = self.inventory_rect.top
-                offset_x = 10
-                offset_y = 20
-                offset2_x = 25 - Player.inventory[i].image.get_rect().width*0.5
-                offset2_y = 25 - Player.inventory[i].image.get_rect().height*0.5
-                offset3_x = 50 * (i % 5)
-                offset3_y = 50 * int(i / 5)
-                screen.blit(Player.inventory[i].image,
-                            (dx + offset_x + offset2_x + offset3_x, dy + offset_y + offset2_y + offset3_y))
+        layer.blit(self.drop_image, (dx + offset_x, dy + offset_y))
 
         # equipment rect
         dx = self.equipment_rect.left
         dy = self.equipment_rect.top
         offset_x = 20
         offset_y = 20
-        screen.blit(self.weapon_equipment_image, (dx + offset_x, dy + offset_y))
+        layer.blit(self.weapon_equipment_image, (dx + offset_x, dy + offset_y))
         offset_y += 20 + 50
-        screen.blit(self.accessory_equipment_image, (dx + offset_x, dy + offset_y))
+        layer.blit(self.accessory_equipment_image, (dx + offset_x, dy + offset_y))
         offset_y += 20 + 50
-        screen.blit(self.boots_equipment_image, (dx + offset_x, dy + offset_y))
-        dx = self.equipment_rect.centerx
-        dy = self.equipment_rect.centery
-        offset_x = self.party.members[0].image.get_rect().width*0.5
-        offset_y = self.party.members[0].image.get_rect().height*0.5
-        screen.blit(self.party.members[0].image,
-                    (dx - offset_x, dy - offset_y))
+        layer.blit(self.boots_equipment_image, (dx + offset_x, dy + offset_y))
         dx = self.equipment_rect.right
         dy = self.equipment_rect.top
         offset_x = 20 + 50
         offset_y = 20
-        screen.blit(self.head_equipment_image, (dx - offset_x, dy + offset_y))
+        layer.blit(self.head_equipment_image, (dx - offset_x, dy + offset_y))
         offset_y += 20 + 50
-        screen.blit(self.body_equipment_image, (dx - offset_x, dy + offset_y))
+        layer.blit(self.body_equipment_image, (dx - offset_x, dy + offset_y))
         offset_y += 20 + 50
-        screen.blit(self.hand_equipment_image, (dx - offset_x, dy + offset_y))
+        layer.blit(self.hand_equipment_image, (dx - offset_x, dy + offset_y))
+
+        # status rect
+        for i in range(len(self.STATUS)):
+            dx = self.status_rect.left
+            dy = self.status_rect.top
+            dx += self.status_rect.width * 0.33 * int(i / 3)
+            dy += 30 * (i % 3)
+            layer.blit(self.status_images[i], (dx, dy))
+            self.message_engine.draw(layer, self.STATUS[i], (dx + 30, dy))
+            layer.blit(self.cursor_right_image, (dx + 70, dy))
+
+        # text rect
+        pygame.draw.rect(layer, WHITE, self.text_rect, 0)
+        pygame.draw.rect(layer, BLACK, self.text_inner_rect, 0)
+        return layer
+
+    def draw_items(self, layer):
+        # draw items in bag
+        dx = self.bag_rect.centerx
+        dy = self.bag_rect.top
+        offset_x = self.bag_image.get_rect().width*0.5
+        for i in range(5):
+            item = self.selected_player.bag[i]
+            if item:
+                offset2_x = 25 - item.image.get_rect().width*0.5
+                offset3_x = 50 * i
+                offset2_y = self.bag_image.get_rect().height * 0.5 - item.image.get_rect().height * 0.5
+                layer.blit(item.image, (dx - offset_x + offset2_x + offset3_x, dy + offset2_y))
+
+        # draw items in the inventory
+        for i in range(len(Player.inventory)):
+            if Player.inventory[i]:
+                dx = self.inventory_rect.left
+                dy = self.inventory_rect.top
+                offset_x = 10
+                offset_y = 20
+                offset2_x = 25 - Player.inventory[i].image.get_rect().width*0.5
+                offset2_y = 25 - Player.inventory[i].image.get_rect().height*0.5
+                offset3_x = 50 * (i % 5)
+                offset3_y = 50 * int(i / 5)
+                layer.blit(Player.inventory[i].image,
+                           (dx + offset_x + offset2_x + offset3_x, dy + offset_y + offset2_y + offset3_y))
 
         # draw items in equipment rect
         equipments = [self.selected_player.weapon, self.selected_player.head,
@@ -2891,8 +3964,8 @@ class ItemWindow(Window):
                     offset2_x = 25 - equipments[i].image.get_rect().width*0.5
                     offset2_y = 25 - equipments[i].image.get_rect().height*0.5
                     offset3_y = int(i / 2) * (20 + 50)
-                    screen.blit(equipments[i].image,
-                                (dx + offset_x + offset2_x, dy + offset_y + offset2_y + offset3_y))
+                    layer.blit(equipments[i].image,
+                               (dx + offset_x + offset2_x, dy + offset_y + offset2_y + offset3_y))
                 else:
                     dx = self.equipment_rect.right
                     dy = self.equipment_rect.top
@@ -2901,10 +3974,10 @@ class ItemWindow(Window):
                     offset2_x = 25 - equipments[i].image.get_rect().width * 0.5
                     offset2_y = 25 - equipments[i].image.get_rect().height * 0.5
                     offset3_y = int(i / 2) * (20 + 50)
-                    screen.blit(equipments[i].image,
-                                (dx - offset_x - offset2_x, dy + offset_y + offset2_y + offset3_y))
+                    layer.blit(equipments[i].image,
+                               (dx - offset_x - offset2_x, dy + offset_y + offset2_y + offset3_y))
 
-        # status rect
+        # status values
         status = [self.selected_player.health, self.selected_player.attack, self.selected_player.intelligence,
                   self.selected_player.defence, self.selected_player.magic_resistance, self.selected_player.agility,
                   self.selected_player.critical_hit, self.selected_player.experience]
@@ -2913,14 +3986,29 @@ class ItemWindow(Window):
             dy = self.status_rect.top
             dx += self.status_rect.width * 0.33 * int(i / 3)
             dy += 30 * (i % 3)
-            screen.blit(self.status_images[i], (dx, dy))
-            self.message_engine.draw(screen, self.STATUS[i], (dx + 30, dy))
-            screen.blit(self.cursor_right_image, (dx + 70, dy))
-            self.message_engine.draw(screen, str(status[i]), (dx + 100, dy))
+            self.message_engine.draw(layer, str(status[i]), (dx + 100, dy))
 
-        # text rect
-        pygame.draw.rect(screen, WHITE, self.text_rect, 0)
-        pygame.draw.rect(screen, BLACK, self.text_inner_rect, 0)
+    def update(self):
+        self.party.members[0].update()
+
+    def draw(self, screen):
+        mark_changed(self, (self.cursor_is_in, self.cursor_position, self.is_grabbing, self.selected_item, self.page,
+                            tuple(Player.inventory), tuple(self.selected_player.bag),
+                            self.selected_player.weapon, self.selected_player.head, self.selected_player.accessory,
+                            self.selected_player.body, self.selected_player.boots, self.selected_player.arms),
+                     self.rect)
+        # draw boards, items and status
+        screen.blit(self.get_item_layer(), (0, 0))
+
+        # draw the player
+        dx = self.equipment_rect.centerx
+        dy = self.equipment_rect.centery
+        offset_x = self.party.members[0].image.get_rect().width*0.5
+        offset_y = self.party.members[0].image.get_rect().height*0.5
+        player_rect = screen.blit(self.party.members[0].image,
+                                  (dx - offset_x, dy - offset_y))
+        # the player walks every frame
+        mark_dirty(player_rect)
 
         # draw cursor
         if self.cursor_is_in == self.INVENTORY_RECT:
@@ -3005,5 +4093,19 @@ class ItemWindow(Window):
 
 
 if __name__ == "__main__":
-    pyRPG()
+    if sys.argv[1:2] == ["pack"]:
+        # python main.py pack compiles the data files and the images into data/assets.pack
+        print(AssetPack.build(AssetPack.FILE_PATH), "files packed into", AssetPack.FILE_PATH)
+    elif sys.argv[1:2] == ["convert"]:
+        # python main.py convert data/town.map ... writes data/town.wld ...
+        for map_file_path in sys.argv[2:]:
+            World.convert(map_file_path, os.path.splitext(map_file_path)[0]+".wld")
+    elif sys.argv[1:2] == ["fps"]:
+        # python main.py fps 0 draws as many frames as possible, for benchmarking
+        if len(sys.argv) < 3 or not sys.argv[2].isdigit():
+            print("usage: python main.py fps <frames per second, 0 for uncapped>")
+        else:
+            pyRPG(int(sys.argv[2]))
+    else:
+        pyRPG()
 